@@ -0,0 +1,76 @@
+# Messages per second between machines run by intlang.aio: a ring of relays
+# passing values through shared queues, and a relay behind a loopback socket
+# against the same relay as a run_intcode subprocess. Run with
+# `make bench_aio`.
+import asyncio
+import os
+from time import perf_counter
+
+from intlang import aio
+
+N_MACHINES = 200
+ROUNDS = 1000
+N_MESSAGES = 100000
+
+# Reads a value and outputs it plus one, `rounds` times.
+RELAY = '3,16,1001,16,1,16,4,16,1001,17,-1,17,1005,17,0,99,0,{rounds}'
+
+
+async def ring():
+    group = aio.Group()
+    queues = [asyncio.Queue() for _ in range(N_MACHINES)]
+    for i in range(N_MACHINES):
+        group.start(RELAY.format(rounds=ROUNDS), queues[i], queues[(i + 1) % N_MACHINES])
+    await group.idle()
+    start = perf_counter()
+    for queue in queues:
+        queue.put_nowait(0)
+    await group.join()
+    return N_MACHINES * ROUNDS / (perf_counter() - start)
+
+
+async def exchange(reader, writer):
+    # Sends N_MESSAGES values and reads the answers back.
+    async def send():
+        batch = b'0\n' * 1000
+        for _ in range(N_MESSAGES // 1000):
+            writer.write(batch)
+            await writer.drain()
+
+    start = perf_counter()
+    sending = asyncio.ensure_future(send())
+    for _ in range(N_MESSAGES):
+        await reader.readline()
+    await sending
+    return N_MESSAGES / (perf_counter() - start)
+
+
+async def loopback():
+    machine = aio.AsyncMachine(RELAY.format(rounds=N_MESSAGES))
+    reader, writer = await aio.loopback(machine)
+    rate = await exchange(reader, writer)
+    writer.close()
+    return rate
+
+
+async def subprocess():
+    with open('/tmp/intcode_bench_relay.ic', 'w') as f:
+        f.write(RELAY.format(rounds=N_MESSAGES))
+    process = await asyncio.create_subprocess_exec(
+        './run_intcode', '/tmp/intcode_bench_relay.ic',
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+    rate = await exchange(process.stdout, process.stdin)
+    process.stdin.close()
+    await process.wait()
+    os.remove('/tmp/intcode_bench_relay.ic')
+    return rate
+
+
+def main():
+    print(f'{N_MACHINES} machines in a ring: {asyncio.run(ring()) / 1e6:6.2f}M messages/s')
+    print(f'loopback socket:        {asyncio.run(loopback()) / 1e6:6.2f}M messages/s')
+    print(f'run_intcode subprocess: {asyncio.run(subprocess()) / 1e6:6.2f}M messages/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+# Day 2 part 2 as a grid search: the day 2 program with every noun/verb
+# pair patched in, run as the lanes of one intlang.batch.Batch, and as one
+# intcode_vm_run per pair through intlang.vm. Run with `make bench_batch`.
+from time import perf_counter
+
+import numpy as np
+
+from intlang import batch, vm
+
+TARGET = 19690720
+
+
+def main():
+    with open('day2_p1.ic') as f:
+        cells = batch.image_cells(f.read())
+    nouns, verbs = (x.ravel() for x in np.meshgrid(np.arange(100), np.arange(100), indexing='ij'))
+
+    start = perf_counter()
+    lanes = batch.Batch(cells, len(nouns))
+    lanes.mem[:, 1], lanes.mem[:, 2] = nouns, verbs
+    mem0, outputs = lanes.run()
+    batched = perf_counter() - start
+    (found,) = np.flatnonzero(mem0 == TARGET)
+
+    start = perf_counter()
+    results = []
+    for noun, verb in zip(nouns.tolist(), verbs.tolist()):
+        cells[1], cells[2] = noun, verb
+        machine = vm.Machine(cells)
+        machine.run()
+        results.append(machine.read()[0])
+    sequential = perf_counter() - start
+    assert results == mem0.tolist() == [x[0] for x in outputs]
+
+    print(f'noun {nouns[found]}, verb {verbs[found]}')
+    print(f'batch of {len(nouns)}:      {batched * 1e3:8.1f}ms ({lanes.n_steps} steps)')
+    print(f'{len(nouns)} sequential runs: {sequential * 1e3:8.1f}ms ({sequential / batched:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
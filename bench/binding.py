@@ -0,0 +1,38 @@
+# Time to run a small compiled program by spawning run_intcode with the
+# text format on a pipe, as the Makefile targets do, and with intlang.vm in
+# this process. Run with `make bench_binding`.
+import subprocess
+from time import perf_counter
+
+from intlang import vm
+from intlang.compiler import Compiler
+from intlang.parser import Parser
+
+N_RUNS = 200
+
+
+def main():
+    with open('intlang/tests/2.il') as f:
+        ast = Parser().parse(f.read())
+    compiler = Compiler(stack_size=2 * 1024, heap_size=4 * 1024)
+    text = compiler.compile(ast)
+    image = compiler.compile(ast, binary=True)
+
+    start = perf_counter()
+    for _ in range(N_RUNS):
+        stdout = subprocess.run(['./run_intcode', '/dev/stdin'], input=text,
+                                capture_output=True, text=True, check=True).stdout
+        [int(x) for x in stdout.split()]
+    spawned = (perf_counter() - start) / N_RUNS
+
+    start = perf_counter()
+    for _ in range(N_RUNS):
+        vm.run(image)
+    in_process = (perf_counter() - start) / N_RUNS
+
+    print(f'run_intcode: {spawned * 1e6:8.1f}us per run')
+    print(f'intlang.vm:  {in_process * 1e6:8.1f}us per run ({spawned / in_process:.0f}x)')
+
+
+if __name__ == '__main__':
+    main()
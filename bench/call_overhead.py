@@ -0,0 +1,61 @@
+# Instructions executed per call for each compiler target, measured as the
+# difference between a loop that calls a function and the same loop without
+# the call. Run with `make bench_call_overhead`.
+import os
+import subprocess
+import tempfile
+
+from intlang.compiler import Compiler, TARGETS
+from intlang.parser import Parser
+
+N_CALLS = 10000
+
+PROGRAM = '''fn f(a, b)
+  x = a + 1
+  if x = b
+    x
+  else
+    b
+  end
+end
+
+fn main()
+  i = 0
+  s = 0
+  while i < {n}
+    s = {body}
+    i = i + 1
+  end
+  print(s)
+end
+'''
+
+
+def executed(code):
+    with tempfile.NamedTemporaryFile('w', suffix='.ic') as f:
+        f.write(code)
+        f.flush()
+        result = subprocess.run(
+            ['./run_intcode', f.name], capture_output=True, text=True,
+            env=dict(os.environ, INTCODE_STATS='1'), check=True)
+    return int(result.stderr.split()[1])
+
+
+def measure(target, optimize, body):
+    ast = Parser().parse(PROGRAM.format(n=N_CALLS, body=body))
+    compiler = Compiler(stack_size=2 * 1024, heap_size=4 * 1024,
+                        optimize=optimize, target=target)
+    return executed(compiler.compile(ast))
+
+
+def main():
+    for optimize in (0, 1):
+        for target in TARGETS:
+            with_calls = measure(target, optimize, 'f(i, s)')
+            without = measure(target, optimize, 's + i')
+            print(f'{target:8s} -O{optimize}: '
+                  f'{(with_calls - without) / N_CALLS:.1f} instructions/call')
+
+
+if __name__ == '__main__':
+    main()
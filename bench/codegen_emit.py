@@ -0,0 +1,22 @@
+# Emission throughput of a single FunctionBuilder.
+# Run with `make bench_codegen`.
+from time import perf_counter
+
+from intlang.code_generator import CodeGenerator, Immediate
+
+N_INSTRUCTIONS = 1000000
+
+
+def main():
+    cg = CodeGenerator(stack_size=2 * 1024, heap_size=4 * 1024)
+    f = cg.new_function()
+    start = perf_counter()
+    for i in range(N_INSTRUCTIONS):
+        f.add('r0', Immediate(i), 'r0')
+    elapsed = perf_counter() - start
+    print(f'emitted {N_INSTRUCTIONS} instructions ({f.size} intcodes) '
+          f'in {elapsed:.3f}s ({N_INSTRUCTIONS / elapsed:.0f} instructions/s)')
+
+
+if __name__ == '__main__':
+    main()
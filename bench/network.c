@@ -0,0 +1,90 @@
+// Messages per second through intcode_network_run, for a 5-stage loop (each
+// VM writes straight into the input ring of the next one) and a 50-node mesh
+// (every node feeds two others, so values are copied). Run with
+// `make bench_network`.
+#include <stdio.h>
+#include <stdlib.h>
+#include <time.h>
+#include "../vm/intcode_network.h"
+
+#define MIN_SECONDS 1.0
+#define ROUNDS 100000
+
+static double now() {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+// Reads a value and outputs it plus one, ROUNDS times.
+static intcode_vm* relay() {
+  char source[64];
+  snprintf(source, sizeof(source), "3,16,1001,16,1,16,4,16,1001,17,-1,17,1005,17,0,99,0,%d", ROUNDS);
+  return intcode_vm_new(source);
+}
+
+// Reads two values and outputs the first plus one, ROUNDS times.
+static intcode_vm* mesh_node() {
+  char source[96];
+  snprintf(source, sizeof(source),
+           "3,20,3,21,1001,20,1,22,4,22,1001,23,-1,23,1005,23,0,99,0,0,0,0,0,%d", ROUNDS);
+  return intcode_vm_new(source);
+}
+
+static intcode_network* stage_loop() {
+  intcode_network* net = intcode_network_new();
+  for (int i = 0; i < 5; i++) {
+    char name[16];
+    snprintf(name, sizeof(name), "stage%d", i);
+    intcode_network_add(net, name, relay());
+  }
+  for (int i = 0; i < 5; i++) intcode_network_connect(net, i, (i + 1) % 5);
+  intcode_network_feed(net, 0, 0);
+  return net;
+}
+
+static intcode_network* mesh() {
+  intcode_network* net = intcode_network_new();
+  for (int i = 0; i < 50; i++) {
+    char name[16];
+    snprintf(name, sizeof(name), "node%d", i);
+    intcode_network_add(net, name, mesh_node());
+  }
+  for (int i = 0; i < 50; i++) {
+    intcode_network_connect(net, i, (i + 1) % 50);
+    intcode_network_connect(net, i, (i + 7) % 50);
+    intcode_network_feed(net, i, 0);
+    intcode_network_feed(net, i, 0);
+  }
+  return net;
+}
+
+// Runs fresh copies of a network for at least MIN_SECONDS. Every node outputs
+// ROUNDS values to each of its `fan_out` targets.
+static void bench(const char* name, intcode_network* (*build)(), int fan_out) {
+  unsigned long long messages = 0, executed = 0, rounds = 0;
+  double elapsed = 0;
+  int n_runs = 0;
+  while (elapsed < MIN_SECONDS) {
+    intcode_network* net = build();
+    double start = now();
+    if (intcode_network_run(net) != 0) {
+      fprintf(stderr, "%s: %s\n", name, net->error);
+      exit(1);
+    }
+    elapsed += now() - start;
+    messages += (unsigned long long)net->n_nodes * ROUNDS * fan_out;
+    for (unsigned int i = 0; i < net->n_nodes; i++) executed += net->nodes[i].vm->n_executed;
+    rounds = net->n_rounds;
+    n_runs++;
+    intcode_network_destroy(&net);
+  }
+  fprintf(stderr, "%-12s %8.2fM messages/s %8.2fM instructions/s %10llu rounds %8.2fms per run\n",
+          name, messages / elapsed / 1e6, executed / elapsed / 1e6, rounds, elapsed / n_runs * 1e3);
+}
+
+int main() {
+  bench("5-stage loop", stage_loop, 1);
+  bench("50-node mesh", mesh, 2);
+  return 0;
+}
@@ -0,0 +1,51 @@
+# Parse throughput for generated Intlang programs of growing size.
+# Run with `make bench_parse`. Lines/sec should stay roughly flat from 1k to
+# 100k lines if parsing scales linearly.
+from time import perf_counter
+
+from intlang.parser import Parser
+
+FUNCTION = '''fn f{n}(a, b)
+  x = a + b * 2
+  y[x][a] = (x - 1) / 3
+  if x > b and not y[0] = 1
+    print(f{n}(x - 1, b))
+  else
+    z = [a, b, x + y[1]]
+  end
+  x
+end
+'''
+
+# Indexed statements that are not assignments are parsed twice without
+# packrat mode: once as a failed assignment, once as an expression.
+NESTED_FUNCTION = '''fn g{n}(a)
+  a[a[a[a[a[a[a[a[1]]]]]]]] + a[a[a[a[a[a[a[a[2]]]]]]]]
+end
+'''
+
+
+def generate(n_lines, function=FUNCTION):
+    lines_per_function = function.count('\n')
+    return ''.join(function.format(n=i)
+                   for i in range(n_lines // lines_per_function))
+
+
+def measure(source, packrat):
+    start = perf_counter()
+    Parser(packrat=packrat).parse(source)
+    return perf_counter() - start
+
+
+def main():
+    for name, function in (('mixed', FUNCTION), ('nested', NESTED_FUNCTION)):
+        for n_lines in (1000, 10000, 100000):
+            source = generate(n_lines, function)
+            for packrat in (False, True):
+                elapsed = measure(source, packrat)
+                print(f'{name:6s} {n_lines:7d} lines, packrat={packrat!s:5s}: '
+                      f'{elapsed:8.3f}s ({n_lines / elapsed:10.0f} lines/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+# Image size and executed instructions of a program with a large puzzle
+# input, with the input as a constant list literal (placed in the data
+# section) and with elements that are only known at runtime (built in the
+# stack frame on every call). Run with `make bench_static_data`.
+import os
+import subprocess
+import tempfile
+
+from intlang.compiler import Compiler
+from intlang.parser import Parser
+
+N_ELEMENTS = 1000
+
+PROGRAM = '''fn input(z)
+  [{elements}]
+end
+
+fn main()
+  print(len(input(0)))
+end
+'''
+
+
+def run(code):
+    with tempfile.NamedTemporaryFile('w', suffix='.ic') as f:
+        f.write(code)
+        f.flush()
+        result = subprocess.run(
+            ['./run_intcode', f.name], capture_output=True, text=True,
+            env=dict(os.environ, INTCODE_STATS='1'), check=True)
+    return result.stderr.strip()
+
+
+def main():
+    for name, element in (('constant', '{i}'), ('runtime', '{i} + z')):
+        elements = ', '.join(element.format(i=i) for i in range(N_ELEMENTS))
+        ast = Parser().parse(PROGRAM.format(elements=elements))
+        code = Compiler(stack_size=8 * 1024, heap_size=4 * 1024).compile(ast)
+        print(f'{name:8s} {N_ELEMENTS} elements: {len(code.split(",")):7d} cells, '
+              f'{run(code)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+// Instructions per second of the decoded-instruction loop (intcode_vm_run)
+// against the plain fetch-decode-execute loop (intcode_vm_run_uncached).
+// Run with `make bench_vm_ips`, which also builds it with -DINTCODE_NO_FUSION;
+// results go to stderr, program output to stdout.
+#include <stdio.h>
+#include <stdlib.h>
+#include <time.h>
+#include "../vm/intcode_vm.h"
+
+#define MIN_SECONDS 1.0
+
+static double now() {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+// Runs the program until at least MIN_SECONDS were spent in `run`, loading a
+// fresh copy each time since programs modify themselves. Returns the
+// instructions per second and sets the dispatches and time of one run.
+// intcode_vm_run with an output ring, printing like the uncached loop does
+static intcode_int run_cached(intcode_vm* vm) {
+  intcode_int cells[4096], value;
+  intcode_ring output;
+  intcode_ring_init(&output, cells, 4096);
+  intcode_vm_attach(vm, NULL, &output);
+  while (intcode_vm_run(vm) == INTCODE_HAVE_OUTPUT) {
+    while (intcode_ring_pop(&output, &value)) printf("%lld\n", value);
+  }
+  while (intcode_ring_pop(&output, &value)) printf("%lld\n", value);
+  return vm->mem[0];
+}
+
+static double bench(const char *path, intcode_int (*run)(intcode_vm*),
+                    unsigned long long *dispatched, double *per_run) {
+  unsigned long long executed = 0;
+  double elapsed = 0;
+  int n_runs = 0;
+  while (elapsed < MIN_SECONDS) {
+    intcode_vm* vm = intcode_vm_load(path);
+    double start = now();
+    run(vm);
+    elapsed += now() - start;
+    executed += vm->n_executed;
+    *dispatched = vm->n_dispatched;
+    n_runs++;
+    intcode_vm_destroy(&vm);
+  }
+  *per_run = elapsed / n_runs;
+  return executed / elapsed;
+}
+
+int main(int argc, char **argv) {
+  for (int i = 1; i < argc; i++) {
+    intcode_vm* vm = intcode_vm_load(argv[i]);
+    if (vm == NULL) {
+      fprintf(stderr, "%s: cannot load program\n", argv[i]);
+      return 1;
+    }
+    intcode_vm_destroy(&vm);
+
+    unsigned long long dispatched;
+    double per_run;
+    double ips = bench(argv[i], intcode_vm_run_uncached, &dispatched, &per_run);
+    fprintf(stderr, "%s: uncached %.1fM/s, %llu dispatches in %.3fms\n",
+            argv[i], ips / 1e6, dispatched, per_run * 1000);
+    ips = bench(argv[i], run_cached, &dispatched, &per_run);
+    fprintf(stderr, "%s: decoded  %.1fM/s, %llu dispatches in %.3fms\n",
+            argv[i], ips / 1e6, dispatched, per_run * 1000);
+  }
+  return 0;
+}
@@ -0,0 +1,52 @@
+// Startup time of a 50MB program, as text and as a binary image.
+// Run with `make bench_vm_load`.
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+#include "../vm/intcode_vm.h"
+
+#define PROGRAM_BYTES (50 * 1024 * 1024)
+
+static double now() {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+static void bench(const char *label, const char *path) {
+  double start = now();
+  intcode_vm* vm = intcode_vm_load(path);
+  double elapsed = now() - start;
+  printf("%-6s %10u cells loaded in %8.3fms\n", label, vm->mem_size, elapsed * 1000);
+  intcode_vm_destroy(&vm);
+}
+
+int main() {
+  const char *text_path = "/tmp/intcode_bench.ic";
+  const char *image_path = "/tmp/intcode_bench.bin";
+
+  FILE *fp = fopen(text_path, "w");
+  unsigned int n_text = 0;
+  for (long written = 0; written < PROGRAM_BYTES; n_text++) {
+    written += fprintf(fp, "%s%d", n_text ? "," : "", (int)(n_text * 7919 % 200000) - 100000);
+  }
+  fclose(fp);
+
+  intcode_image_header header = { INTCODE_IMAGE_MAGIC, PROGRAM_BYTES / sizeof(intcode_int), { 0 } };
+  fp = fopen(image_path, "wb");
+  fwrite(&header, sizeof(header), 1, fp);
+  for (intcode_int i = 0; i < header.n_cells; i++) {
+    intcode_int cell = i * 7919 % 200000 - 100000;
+    fwrite(&cell, sizeof(cell), 1, fp);
+  }
+  fclose(fp);
+
+  bench("text", text_path);
+  bench("binary", image_path);
+
+  unlink(text_path);
+  unlink(image_path);
+  return 0;
+}
@@ -1,17 +1,51 @@
 from intlang.parser import Parser
-from intlang.compiler import Compiler
-import sys
+from intlang.compiler import Compiler, TARGETS
+import argparse
 import os
 
+arg_parser = argparse.ArgumentParser(prog='python -m intlang')
+arg_parser.add_argument('input')
+arg_parser.add_argument('output', nargs='?')
+arg_parser.add_argument('--run', action='store_true',
+                        help='run the program with intlang.vm and print its '
+                             'output instead of writing it')
+arg_parser.add_argument('--format', choices=('text', 'bin'), default='text',
+                        help='comma-separated decimal (default) or a binary image')
+arg_parser.add_argument('-O', type=int, default=1, dest='optimize', metavar='LEVEL',
+                        help='0 disables the peephole optimizer (default: 1)')
+arg_parser.add_argument('--packrat', action='store_true',
+                        help='memoize the parser rules, for sources that backtrack a lot')
+arg_parser.add_argument('--target', choices=TARGETS, default='classic',
+                        help='relative also uses opcodes 5-9 and relative mode, '
+                             'which not every VM has (default: classic)')
+args = arg_parser.parse_args()
+if args.output is None and not args.run:
+    arg_parser.error('the following arguments are required: output')
 
-with open(sys.argv[1]) as f_in, open(sys.argv[2], 'w') as f_out:
-    parser = Parser()
-    ast = parser.parse(f_in.read())
-    compiler = Compiler(
+
+def new_compiler():
+    return Compiler(
         stack_size=int(os.getenv('STACK_SIZE', 2 * 1024)),
-        heap_size=int(os.getenv('HEAP_SIZE', 4 * 1024))
+        heap_size=int(os.getenv('HEAP_SIZE', 4 * 1024)),
+        optimize=args.optimize,
+        target=args.target
     )
-    code = compiler.compile(ast)
+
+
+if args.run:
+    from intlang import vm
+    with open(args.input) as f_in:
+        ast = Parser(packrat=args.packrat).parse(f_in.read())
+    for value in vm.run(new_compiler().compile(ast, binary=True)):
+        print(value)
+    raise SystemExit
+
+binary = args.format == 'bin'
+with open(args.input) as f_in, open(args.output, 'wb' if binary else 'w') as f_out:
+    parser = Parser(packrat=args.packrat)
+    ast = parser.parse(f_in.read())
+    compiler = new_compiler()
+    code = compiler.compile(ast, binary=binary)
     f_out.write(code)
     if os.getenv('DEBUG'):
         cg = compiler.code_generator
@@ -0,0 +1,187 @@
+# asyncio driver for intlang.vm: each machine is a task that reads its
+# inputs from an asyncio.Queue and puts its outputs into another one.
+import asyncio
+import socket
+
+from intlang import vm
+
+# Instructions a machine runs before it lets the other tasks run
+SLICE = 10000
+
+# Tasks of serve() started by loopback(), which asyncio only holds weakly
+_serving = set()
+
+
+class AsyncMachine:
+    """
+    A program running as an asyncio task. Values put into `input` are read
+    by IN, and OUT puts values into `output`. Passing the output queue of
+    one machine as the input queue of another connects them.
+    """
+
+    def __init__(self, image, input=None, output=None, slice=SLICE, group=None):
+        self.machine = vm.Machine(image)
+        self.input = asyncio.Queue() if input is None else input
+        self.output = asyncio.Queue() if output is None else output
+        self.slice = slice
+        self.group = group
+        # Set while blocked on an empty input queue
+        self.waiting = False
+        self.task = asyncio.get_running_loop().create_task(self.main())
+
+    def done(self):
+        return self.task.done()
+
+    async def main(self):
+        machine, ring = self.machine, self.machine.input
+        # Instructions count against the slice across runs, whatever made
+        # each run return, until the machine lets the other tasks run.
+        start = machine.n_executed
+        try:
+            while True:
+                status = machine.run(self.slice - (machine.n_executed - start))
+                for value in machine.read():
+                    if self.output.full():
+                        await self.output.put(value)
+                    else:
+                        self.output.put_nowait(value)
+                if status == vm.HALTED:
+                    return
+                if status == vm.NEED_INPUT:
+                    if self.input.empty():
+                        self.waiting = True
+                        if self.group is not None:
+                            self.group.changed()
+                        try:
+                            values = [await self.input.get()]
+                        finally:
+                            self.waiting = False
+                        start = machine.n_executed
+                    else:
+                        values = []
+                    room = ring.capacity - ring.size
+                    while len(values) < room and not self.input.empty():
+                        values.append(self.input.get_nowait())
+                    machine.feed(values)
+                if status == vm.PAUSED or machine.n_executed - start >= self.slice:
+                    await asyncio.sleep(0)
+                    start = machine.n_executed
+        finally:
+            if self.group is not None:
+                self.group.changed()
+
+
+class Group:
+    """
+    Machines started together, so that the moment all of them wait for
+    input can be awaited, as when a network of them has gone quiet. Create
+    it inside the event loop.
+    """
+
+    def __init__(self):
+        self.machines = []
+        self._changed = asyncio.Event()
+
+    def start(self, image, input=None, output=None, slice=SLICE):
+        machine = AsyncMachine(image, input, output, slice, group=self)
+        self.machines.append(machine)
+        return machine
+
+    def changed(self):
+        self._changed.set()
+
+    def is_idle(self):
+        for machine in self.machines:
+            if machine.done():
+                if not machine.task.cancelled() and machine.task.exception():
+                    raise machine.task.exception()
+            elif not machine.waiting or not machine.input.empty():
+                return False
+        return True
+
+    async def idle(self):
+        """
+        Returns once every machine halted or waits for input with none
+        queued, and stays so after the other ready tasks ran. Raises the
+        error of a machine that panicked.
+        """
+        while True:
+            if self.is_idle():
+                await asyncio.sleep(0)
+                if self.is_idle():
+                    return
+            else:
+                self._changed.clear()
+                await self._changed.wait()
+
+    async def join(self):
+        await asyncio.gather(*(machine.task for machine in self.machines))
+
+
+async def serve(machine, reader, writer):
+    """
+    Connects a machine to a stream: each line read is an input, and each
+    output is written as a line. Closes the stream once the machine halted
+    and its outputs were written, or on malformed input, which raises.
+    """
+    def parse(word):
+        try:
+            return int(word)
+        except ValueError:
+            raise Exception(f"Malformed input: {word.decode(errors='replace')}") from None
+
+    async def receive():
+        # Reads whatever arrived, keeping a number that may continue.
+        rest = b''
+        while data := await reader.read(65536):
+            words = (rest + data).split()
+            rest = words.pop() if words and not data[-1:].isspace() else b''
+            for word in words:
+                if machine.input.full():
+                    await machine.input.put(parse(word))
+                else:
+                    machine.input.put_nowait(parse(word))
+        if rest:
+            await machine.input.put(parse(rest))
+
+    receiving = asyncio.ensure_future(receive())
+    getter = None
+    try:
+        while True:
+            if getter is None:
+                getter = asyncio.ensure_future(machine.output.get())
+            waiting = [getter, machine.task]
+            if not receiving.done():
+                waiting.append(receiving)
+            await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            if receiving.done():
+                receiving.result()
+            if not getter.done():
+                if machine.task.done():
+                    break  # the machine halted with nothing left to send
+                continue
+            values = [getter.result()]
+            getter = None
+            while not machine.output.empty():
+                values.append(machine.output.get_nowait())
+            writer.write(''.join(f'{value}\n' for value in values).encode())
+            await writer.drain()
+        machine.task.result()
+    finally:
+        if getter is not None:
+            getter.cancel()
+        receiving.cancel()
+        writer.close()
+
+
+async def loopback(machine):
+    """
+    Serves a machine on one end of a local socket pair, a stand-in for a
+    network connection. Returns the reader and writer of the other end.
+    """
+    ours, theirs = socket.socketpair()
+    reader, writer = await asyncio.open_connection(sock=theirs)
+    task = asyncio.ensure_future(serve(machine, *await asyncio.open_connection(sock=ours)))
+    _serving.add(task)
+    task.add_done_callback(_serving.discard)
+    return reader, writer
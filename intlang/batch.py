@@ -0,0 +1,205 @@
+# Runs one program on many initial memories at once: each lane is a copy of
+# the memory, and the lanes at the same instruction execute it together as
+# NumPy operations. Same semantics as intcode_vm_run (vm/intcode_vm.c).
+import numpy as np
+
+from intlang import vm
+from intlang.code_generator import IMAGE_HEADER, IMAGE_MAGIC
+
+# Status of a lane that has not stopped yet; the others use the values of
+# intcode_status in intlang.vm.
+RUNNING = -1
+
+# Opcodes and their number of operands, see vm/intcode_vm.h
+OP_ADD, OP_MUL, OP_IN, OP_OUT, OP_JT, OP_JF, OP_LT, OP_EQ, OP_ARB = range(1, 10)
+OP_HALT, OP_DIV, OP_JGE = 99, 50, 60
+N_OPERANDS = {OP_ADD: 3, OP_MUL: 3, OP_IN: 1, OP_OUT: 1, OP_JT: 2, OP_JF: 2,
+              OP_LT: 3, OP_EQ: 3, OP_ARB: 1, OP_HALT: 0, OP_DIV: 3, OP_JGE: 3}
+
+MODE_IMMEDIATE, MODE_RELATIVE = 1, 2
+
+
+def image_cells(image):
+    # The cells of any output of Compiler.compile, or of the cells themselves.
+    if isinstance(image, (bytes, bytearray)) and image[:len(IMAGE_MAGIC)] == IMAGE_MAGIC:
+        n_cells = IMAGE_HEADER.unpack_from(image)[1]
+        return np.frombuffer(image, '<i8', n_cells, IMAGE_HEADER.size).astype(np.int64)
+    if isinstance(image, str):
+        return np.array([int(x) for x in image.replace(',', ' ').split()], np.int64)
+    return np.array(image, np.int64)
+
+
+class Batch:
+    """
+    `size` lanes running the same program. Patch `mem` before run(), e.g.
+    `batch.mem[:, 1] = nouns`, then read the result from the lanes.
+    """
+
+    def __init__(self, image, size):
+        self.mem = np.tile(image_cells(image), (size, 1))
+        self.ip = np.zeros(size, np.int64)
+        self.relative_base = np.zeros(size, np.int64)
+        self.status = np.full(size, RUNNING, np.int8)
+        self.errors = {}  # lane -> why it panicked
+        self.inputs = np.zeros((size, 0), np.int64)
+        self.n_read = np.zeros(size, np.int64)
+        # (lanes, values) of each OUT executed, in order
+        self.output_chunks = []
+        self.n_steps = 0
+
+    def run(self, inputs=()):
+        """
+        Runs every lane until it halts, panics or needs more input than it
+        was given. `inputs` is a sequence read by all lanes, or one row per
+        lane, queued after the inputs of the previous runs; lanes that
+        needed input go on with it. Returns mem[0] of each lane and the
+        list of values each one output so far.
+        """
+        inputs = np.array(inputs, np.int64)
+        if inputs.ndim == 1:
+            inputs = np.tile(inputs, (len(self.ip), 1))
+        self.inputs = np.concatenate([self.inputs, inputs], axis=1)
+        # IN left them on the instruction, as intcode_vm_run does.
+        self.status[self.status == vm.NEED_INPUT] = RUNNING
+
+        n_cells = self.mem.shape[1]
+        while True:
+            lanes = np.flatnonzero(self.status == RUNNING)
+            if len(lanes) == 0:
+                break
+            ip = self.ip[lanes]
+            # Running off the end of memory halts, as in intcode_vm_run.
+            off = (ip < 0) | (ip >= n_cells)
+            if off.any():
+                self.status[lanes[off]] = vm.HALTED
+                lanes, ip = lanes[~off], ip[~off]
+                if len(lanes) == 0:
+                    continue
+            if ip.min() == ip.max():
+                groups = [(lanes, ip[0])]
+            else:
+                order = np.argsort(ip, kind='stable')
+                addrs, starts = np.unique(ip[order], return_index=True)
+                groups = zip(np.split(lanes[order], starts[1:]), addrs)
+            self.n_steps += 1
+            for group, addr in groups:
+                # Self-modified lanes may have another instruction here.
+                cells = self.mem[group, addr]
+                if cells.min() == cells.max():
+                    self.execute(group, int(addr), int(cells[0]))
+                else:
+                    for cell in np.unique(cells):
+                        self.execute(group[cells == cell], int(addr), int(cell))
+        return self.mem[:, 0].copy(), self.outputs()
+
+    def outputs(self):
+        # The values output by each lane, as one list per lane.
+        outputs = [[] for _ in range(len(self.ip))]
+        for lanes, values in self.output_chunks:
+            for lane, value in zip(lanes.tolist(), values.tolist()):
+                outputs[lane].append(value)
+        return outputs
+
+    def panic(self, lanes, addr, reason):
+        self.status[lanes] = vm.PANICKED
+        self.ip[lanes] = addr
+        for lane in lanes.tolist():
+            self.errors[lane] = reason
+
+    def operand(self, lanes, addr, mode, n, write=False):
+        # The cell operand n refers to in each lane; the operand itself if it
+        # is an immediate value. Writes take immediates as positions.
+        if mode[n - 1] == MODE_IMMEDIATE and not write:
+            return np.full(len(lanes), addr + n, np.int64)
+        at = self.mem[lanes, addr + n]
+        if mode[n - 1] == MODE_RELATIVE:
+            at = at + self.relative_base[lanes]
+        return at
+
+    def check(self, lanes, addr, *ats):
+        # Panics the lanes where a cell is out of memory and returns a mask
+        # of the others.
+        n_cells = self.mem.shape[1]
+        ok = np.ones(len(lanes), bool)
+        for at in ats:
+            ok &= (at >= 0) & (at < n_cells)
+        if not ok.all():
+            self.panic(lanes[~ok], addr, "bad position")
+        return ok
+
+    def execute(self, lanes, addr, cell):
+        # Executes the instruction `cell` at `addr` in `lanes`.
+        mem = self.mem
+        opcode, modes = (cell % 100, cell // 100) if cell >= 0 else (-1, 0)
+        mode = (modes % 10, modes // 10 % 10, modes // 100 % 10)
+        if opcode not in N_OPERANDS:
+            self.panic(lanes, addr, "wrong opcode")
+            return
+        if addr + N_OPERANDS[opcode] >= mem.shape[1]:
+            self.panic(lanes, addr, "bad position")
+            return
+
+        if opcode in (OP_ADD, OP_MUL, OP_LT, OP_EQ, OP_DIV):
+            a, b, at = (self.operand(lanes, addr, mode, n, n == 3) for n in (1, 2, 3))
+            ok = self.check(lanes, addr, a, b, at)
+            lanes, a, b, at = lanes[ok], a[ok], b[ok], at[ok]
+            a, b = mem[lanes, a], mem[lanes, b]
+            if opcode == OP_ADD:
+                result = a + b
+            elif opcode == OP_MUL:
+                result = a * b
+            elif opcode == OP_LT:
+                result = (a < b).astype(np.int64)
+            elif opcode == OP_EQ:
+                result = (a == b).astype(np.int64)
+            else:
+                zero = b == 0
+                if zero.any():
+                    self.panic(lanes[zero], addr, "division by zero")
+                    lanes, a, b, at = lanes[~zero], a[~zero], b[~zero], at[~zero]
+                # Truncated toward zero, as in C
+                result = np.abs(a) // np.abs(b) * np.where((a < 0) == (b < 0), 1, -1)
+            mem[lanes, at] = result
+            self.ip[lanes] = addr + 4
+        elif opcode in (OP_JT, OP_JF, OP_JGE):
+            n_conditions = 2 if opcode == OP_JGE else 1
+            conditions = [self.operand(lanes, addr, mode, n) for n in range(1, n_conditions + 1)]
+            ok = self.check(lanes, addr, *conditions)
+            lanes = lanes[ok]
+            values = [mem[lanes, at[ok]] for at in conditions]
+            if opcode == OP_JT:
+                jump = values[0] != 0
+            elif opcode == OP_JF:
+                jump = values[0] == 0
+            else:
+                jump = values[0] >= values[1]
+            # The target is only read by the lanes that jump.
+            self.ip[lanes[~jump]] = addr + 1 + N_OPERANDS[opcode]
+            lanes = lanes[jump]
+            target = self.operand(lanes, addr, mode, n_conditions + 1)
+            ok = self.check(lanes, addr, target)
+            self.ip[lanes[ok]] = mem[lanes[ok], target[ok]]
+        elif opcode in (OP_ARB, OP_OUT):
+            at = self.operand(lanes, addr, mode, 1)
+            ok = self.check(lanes, addr, at)
+            lanes = lanes[ok]
+            value = mem[lanes, at[ok]]
+            if opcode == OP_ARB:
+                self.relative_base[lanes] += value
+            else:
+                self.output_chunks.append((lanes, value))
+            self.ip[lanes] = addr + 2
+        elif opcode == OP_IN:
+            ready = self.n_read[lanes] < self.inputs.shape[1]
+            # Stops on IN, like intcode_vm_run without input
+            self.status[lanes[~ready]] = vm.NEED_INPUT
+            lanes = lanes[ready]
+            at = self.operand(lanes, addr, mode, 1, write=True)
+            ok = self.check(lanes, addr, at)
+            lanes = lanes[ok]
+            mem[lanes, at[ok]] = self.inputs[lanes, self.n_read[lanes]]
+            self.n_read[lanes] += 1
+            self.ip[lanes] = addr + 2
+        elif opcode == OP_HALT:
+            # ip stays on HALT, as in intcode_vm_run
+            self.status[lanes] = vm.HALTED
@@ -1,5 +1,14 @@
-from itertools import chain
+from array import array
 import os
+import struct
+import sys
+
+DEBUG = os.getenv('DEBUG')
+
+# Binary image header: magic, cell count and the start of the stack, text,
+# data and heap sections, all little-endian int64 like the cells after it.
+IMAGE_MAGIC = b'INTCODE\0'
+IMAGE_HEADER = struct.Struct('<8sqqqqq')
 
 
 class Address:
@@ -7,17 +16,23 @@ class Address:
         self.address = None
         self.size = 0
         self.content = []
+        # offset -> value of the cells whose value is only known at link
+        # time: pointers, registers, `$+N` offsets and lazy Immediates.
+        self.relocations = {}
         self.resize(size)
 
     def resize(self, size):
         if self.address is not None:
             raise Exception(
                 "This address cannot be resized since it is already assigned.")
+        # Grow/shrink in place; list.extend over-allocates, so appending an
+        # instruction at a time is amortized O(1).
         if size > self.size:
-            self.content = self.content + \
-                list(0 for _ in range(size - self.size))
+            self.content.extend([0] * (size - self.size))
         else:
-            self.content = self.content[:-(self.size - size + 1)]
+            del self.content[size:]
+            self.relocations = {
+                k: v for k, v in self.relocations.items() if k < size}
         self.size = size
 
     def grow(self, incr):
@@ -27,10 +42,26 @@ class Address:
         self.resize(self.size - decr)
 
     def append(self, content):
-        if os.getenv('DEBUG'):
+        if DEBUG:
             print(content)
-        self.grow(len(content))
-        self.content[-len(content):] = content
+        if self.address is not None:
+            raise Exception(
+                "This address cannot be resized since it is already assigned.")
+        for value in content:
+            if type(value) != int:
+                self.relocations[self.size] = value
+                value = 0
+            self.content.append(value)
+            self.size += 1
+
+    def write(self, offset, value):
+        # The last write to a cell wins, relocated or not.
+        if type(value) != int:
+            self.relocations[offset] = value
+            value = 0
+        else:
+            self.relocations.pop(offset, None)
+        self.content[offset] = value
 
 
 class Immediate:
@@ -49,6 +80,15 @@ class Position:
         return f'Position({self.intcode})'
 
 
+class Relative:
+    # An operand addressed from the relative base (mode 2)
+    def __init__(self, intcode):
+        self.intcode = intcode
+
+    def __repr__(self):
+        return f'Relative({self.intcode})'
+
+
 class MemorySection:
     def __init__(self):
         self.addresses = []
@@ -77,6 +117,23 @@ class FunctionBuilder:
     def __init__(self, code_generator):
         self.code_generator = code_generator
         self.address = code_generator.text.obtain(0)
+        # Instructions are kept until link time so they can be optimized
+        # as a whole; `size` is the number of intcodes emitted so far.
+        self.instructions = []
+        self.size = 0
+
+    def emit(self, instruction):
+        self.instructions.append(instruction)
+        self.size += len(instruction)
+
+    def flush(self):
+        instructions = self.instructions
+        for optimize in self.code_generator.passes:
+            instructions = optimize(instructions)
+        for instruction in instructions:
+            self.address.append(instruction)
+        self.instructions = []
+        self.size = self.address.size
 
     def add(self, *args):
         self.opcode_with_3_operands(1, *args)
@@ -85,13 +142,28 @@ class FunctionBuilder:
         self.opcode_with_3_operands(2, *args)
 
     def in_(self, arg0):
-        self.address.append([self.calculate_mode(arg0, None, None) + 3, arg0])
+        self.emit([self.calculate_mode(arg0, None, None) + 3, arg0])
 
     def out(self, arg0):
-        self.address.append([self.calculate_mode(arg0, None, None) + 4, arg0])
+        self.emit([self.calculate_mode(arg0, None, None) + 4, arg0])
+
+    def jt(self, arg0, arg1):
+        self.emit([self.calculate_mode(arg0, arg1, None) + 5, arg0, arg1])
+
+    def jf(self, arg0, arg1):
+        self.emit([self.calculate_mode(arg0, arg1, None) + 6, arg0, arg1])
+
+    def lt(self, *args):
+        self.opcode_with_3_operands(7, *args)
+
+    def eq(self, *args):
+        self.opcode_with_3_operands(8, *args)
+
+    def arb(self, arg0):
+        self.emit([self.calculate_mode(arg0, None, None) + 9, arg0])
 
     def halt(self):
-        self.address.append([99])
+        self.emit([99])
 
     # Added, not in the original spec
 
@@ -116,23 +188,33 @@ class FunctionBuilder:
     def read_stack(self, arg_no, arg0, from_='sp'):
         if type(arg_no) != int:
             raise Exception("read_stack <arg number> <arg0>")
+        if from_ == 'bp' and self.code_generator.relative_base:
+            # The relative base is kept equal to bp
+            self.add(Immediate(0), Relative(arg_no + 1), arg0)
+            return
         self.add(from_, Immediate(arg_no + 1), '$+3')
         self.add(Immediate(0), 0, arg0)
 
     def write_stack(self, arg_no, arg0, from_='sp'):
         if type(arg_no) != int:
             raise Exception("write_stack <arg number> <arg0>")
+        if from_ == 'bp' and self.code_generator.relative_base:
+            self.add(Immediate(0), arg0, Relative(arg_no + 1))
+            return
         self.add(from_, Immediate(arg_no + 1), '$+4')
         self.add(Immediate(0), arg0, 0)
 
     def read_arg(self, arg_no, arg0):
         self.read_stack(arg_no, arg0, from_='bp')
 
+    # bp points at the return address and the caller's bp is right below
+    # it, so local 0 is at bp - 2.
+
     def read_local(self, local_no, arg0):
-        self.read_stack(-(local_no + 2), arg0, from_='bp')
+        self.read_stack(-(local_no + 3), arg0, from_='bp')
 
     def write_local(self, local_no, arg0):
-        self.write_stack(-(local_no + 2), arg0, from_='bp')
+        self.write_stack(-(local_no + 3), arg0, from_='bp')
 
     def call(self, arg0):
         self.push(Immediate('$+10'))
@@ -147,24 +229,31 @@ class FunctionBuilder:
 
     # Utils
 
-    def calculate_mode(self, arg0, arg1, arg2):
+    @staticmethod
+    def calculate_mode(arg0, arg1, arg2):
         mode = 0
-        if type(arg0) == Immediate:
-            mode += 100
-        if type(arg1) == Immediate:
-            mode += 1000
-        if type(arg2) == Immediate:
-            mode += 10000
+        for arg, digit in ((arg0, 100), (arg1, 1000), (arg2, 10000)):
+            if type(arg) == Immediate:
+                mode += digit
+            elif type(arg) == Relative:
+                mode += 2 * digit
         return mode
 
     def opcode_with_3_operands(self, opcode, arg0, arg1, arg2):
         mode = self.calculate_mode(arg0, arg1, arg2)
-        self.address.append([mode + opcode, arg0, arg1, arg2])
+        self.emit([mode + opcode, arg0, arg1, arg2])
 
 
 class CodeGenerator:
-    def __init__(self, heap_size, stack_size, register_size=6):
+    def __init__(self, heap_size, stack_size, register_size=6, passes=(),
+                 relative_base=False):
+        # Optimization passes run over each function body before linking.
+        self.passes = passes
+        # Whether the code keeps bp in the relative base (opcode 9, mode 2)
+        # to address args and locals. Needs a VM with the full AoC opcodes.
+        self.relative_base = relative_base
         self.text = MemorySection()
+        self.functions = []
 
         # Initialize stack
         self.stack = MemorySection()
@@ -181,19 +270,50 @@ class CodeGenerator:
 
         # Initialize data
         self.data = MemorySection()
-        self.section_info = self.data.obtain(4)
+        # Start of the stack, text, data and heap, and the end of the heap
+        self.section_info = self.data.obtain(5)
 
         # Initialize heap
         self.heap = MemorySection()
         self.heap.obtain(heap_size)
 
     def new_function(self):
-        return FunctionBuilder(self)
+        f = FunctionBuilder(self)
+        self.functions.append(f)
+        return f
 
     def set_entrypoint(self, entrypoint):
-        self.jmp_code.content = [11160, 0, 0, entrypoint]
+        self.jmp_code.content = [11160, 0, 0, 0]
+        self.jmp_code.write(3, entrypoint)
+
+    def resolve(self, loc, value):
+        # Unbox lazy values
+        # This tags the value for the ops mode, but not needed when compiled.
+        if hasattr(value, 'intcode'):
+            value = value.intcode
+
+        if type(value) == Address:  # Pointer
+            return value.address
+        elif type(value) == str and len(value) == 2:  # Registers
+            if value[0] == 'r':
+                return self.registers[int(value[1])].address
+            elif value == 'sp':
+                return self.registers[-1].address
+            elif value == 'bp':
+                return self.registers[-2].address
+            else:
+                raise Exception(f"Invalid register {value}")
+        elif type(value) == str:  # Offset from the current address
+            if value[0:2] == '$+':
+                return loc + int(value[2:])
+            else:
+                raise Exception(f"String not allowed {value}")
+        else:
+            return value
 
-    def generate(self):
+    def link(self):
+        for f in self.functions:
+            f.flush()
         # text starts where stack ends
         self.text.finalize(base=self.stack.end)
         # data starts where text ends
@@ -203,46 +323,32 @@ class CodeGenerator:
 
         # Fill out the section data
         self.section_info.content = [
-            self.stack.start, self.text.start, self.data.start, self.heap.start]
-
-        # Build the memory in a 1d array
-        memory = list(chain(*[
-            *[addr.content for addr in self.stack.addresses],
-            *[addr.content for addr in self.text.addresses],
-            *[addr.content for addr in self.data.addresses],
-            *[addr.content for addr in self.heap.addresses]
-        ]))
-
-        # Finalize all the pointers and registers to an int value
-        def translate(loc, value):
-            # Unbox lazy values
-            # This tags the value for the ops mode, but not needed when compiled.
-            if hasattr(value, 'intcode'):
-                value = value.intcode
-
-            if type(value) == Address:  # Pointer
-                return value.address
-            elif type(value) == str and len(value) == 2:  # Registers
-                if value[0] == 'r':
-                    return self.registers[int(value[1])].address
-                elif value == 'sp':
-                    return self.registers[-1].address
-                elif value == 'bp':
-                    return self.registers[-2].address
-                else:
-                    raise Exception(f"Invalid register {value}")
-            elif type(value) == str:  # Offset from the current address
-                if value[0:2] == '$+':
-                    return loc + int(value[2:])
-                else:
-                    raise Exception(f"String not allowed {value}")
-            else:
-                return value
-        memory = list(translate(loc, value)
-                      for loc, value in enumerate(memory))
-
-        # Stringify all elements
-        memory = list(str(x) for x in memory)
+            self.stack.start, self.text.start, self.data.start, self.heap.start,
+            self.heap.end]
+
+        # Copy every address into a preallocated image, then patch only the
+        # cells that were recorded as relocations when they were emitted.
+        memory = array('q', bytes(8 * self.heap.end))
+        for section in (self.stack, self.text, self.data, self.heap):
+            for addr in section.addresses:
+                if any(addr.content):
+                    memory[addr.address:addr.address + addr.size] = \
+                        array('q', addr.content)
+                for offset, value in addr.relocations.items():
+                    loc = addr.address + offset
+                    memory[loc] = self.resolve(loc, value)
+        return memory
 
+    def generate(self):
         # Return a string of a Intcode-compiled program.
-        return ','.join(memory)
+        return ','.join(map(str, self.link()))
+
+    def generate_binary(self):
+        # Return a binary image of a Intcode-compiled program.
+        memory = self.link()
+        if sys.byteorder != 'little':
+            memory.byteswap()
+        header = IMAGE_HEADER.pack(
+            IMAGE_MAGIC, len(memory),
+            self.stack.start, self.text.start, self.data.start, self.heap.start)
+        return header + memory.tobytes()
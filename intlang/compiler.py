@@ -1,15 +1,50 @@
 from collections import namedtuple
+import os
 
-from intlang.code_generator import CodeGenerator, MemorySection, Immediate, Position, Address
+from intlang.code_generator import CodeGenerator, MemorySection, Immediate, Position, Relative, Address
+from intlang.parser import ASTNode, Parser, Token
+from intlang import optimizer, peephole
 
 GlobalVariableBuilder = namedtuple('GlobalVariableBuilder', 'address')
 
+# classic: ADD, MUL, IN, OUT, HALT, DIV and JGE only.
+# relative: also the rest of the AoC opcodes, with bp kept in the relative base.
+TARGETS = ('classic', 'relative')
+# Registers available to expressions; the other two cells are bp and sp.
+REGISTERS = ['r0', 'r1', 'r2', 'r3']
+# Pseudo operator for a[x]
+INDEX = Token('INDEX', '[')
+# Intlang source of the builtins that are not hand-written (alloc, free)
+RUNTIME = os.path.join(os.path.dirname(__file__), 'runtime.il')
+
+
+def contains(tree, kind):
+    if isinstance(tree, list):
+        return any(contains(x, kind) for x in tree)
+    if isinstance(tree, ASTNode):
+        return tree.kind == kind or contains(tree.children, kind)
+    return False
+
+
+def identifiers(tree):
+    if isinstance(tree, list):
+        for x in tree:
+            yield from identifiers(x)
+    elif isinstance(tree, ASTNode):
+        yield from identifiers(tree.children)
+    elif tree.kind == 'IDENT':
+        yield tree.text
+
 
 class Compiler:
 
-    def __init__(self, stack_size, heap_size):
+    def __init__(self, stack_size, heap_size, optimize=1, target='classic'):
+        if target not in TARGETS:
+            raise Exception(f'Unknown target: {target}')
         self.stack_size = stack_size
         self.heap_size = heap_size
+        self.optimize = optimize
+        self.target = target
         self.reset()
 
     def reset(self):
@@ -17,7 +52,9 @@ class Compiler:
         self.local_scope = {}
         self.code_generator = CodeGenerator(
             stack_size=self.stack_size,
-            heap_size=self.heap_size
+            heap_size=self.heap_size,
+            passes=[peephole.optimize] if self.optimize >= 1 else [],
+            relative_base=self.target == 'relative'
         )
 
     def set_var(self, f, scope, name, value):
@@ -53,35 +90,202 @@ class Compiler:
         else:
             raise Exception(f'Undefined variable: {name}')
 
+    def compile_operator(self, f, op, a, b, dest, scratch=None):
+        # dest = a <op> b; a and b may be overwritten.
+        if op.kind == 'ADD':
+            f.add(a, b, dest)
+        elif op.kind == 'SUB':
+            f.mul(b, Immediate(-1), b)
+            f.add(a, b, dest)
+        elif op.kind == 'MUL':
+            f.mul(a, b, dest)
+        elif op.kind == 'DIV':
+            f.div(a, b, dest)
+        elif op.kind == 'LT':
+            # if -a + b is a positive integer, true.
+            f.mul(a, Immediate(-1), a)
+            f.add(a, b, dest)
+        elif op.kind == 'LTE':
+            # if -a + (b + 1) is a positive integer, true.
+            f.add(b, Immediate(1), b)
+            f.mul(a, Immediate(-1), a)
+            f.add(a, b, dest)
+        elif op.kind in ('EQ', 'NEQ') and self.target == 'relative':
+            f.eq(a, b, dest)
+            if op.kind == 'NEQ':
+                f.eq(dest, Immediate(0), dest)
+        elif op.kind in ('EQ', 'NEQ'):
+            equal, not_equal = (1, 0) if op.kind == 'EQ' else (0, 1)
+            if scratch is None:
+                # Compare a - b against 0 instead, which frees b as the scratch.
+                f.mul(b, Immediate(-1), b)
+                f.add(a, b, a)
+                b, scratch = Immediate(0), b
+            f.add(Immediate(0), Immediate(equal), scratch)
+            f.jge(a, b, Immediate('$+5'))
+            f.add(Immediate(0), Immediate(not_equal), scratch)
+            f.jge(b, a, Immediate('$+5'))
+            f.add(Immediate(0), Immediate(not_equal), scratch)
+            f.add(scratch, Immediate(0), dest)
+        elif op.kind == 'GT':
+            f.mul(b, Immediate(-1), b)
+            f.add(a, b, dest)
+        elif op.kind == 'GTE':
+            f.add(a, Immediate(1), a)
+            f.mul(b, Immediate(-1), b)
+            f.add(a, b, dest)
+        elif op.kind == 'INDEX':
+            f.add(a, b, '$+3')  # a = base, b = offset
+            f.add(Immediate(0), 0, dest)
+        else:
+            raise Exception(f"Unimplemented: {op}")
+
+    def compile_logical_jump(self, f, op, reg):
+        # `a and b` is a if a is false and b otherwise; `a or b` is a if a is
+        # true and b otherwise. With a in reg, this jumps over the code of b
+        # when b is not needed; the caller sets the returned offset.
+        end_addr = Immediate(0)
+        if op.kind == 'AND':
+            f.jge(Immediate(0), reg, end_addr)
+        else:
+            f.jge(reg, Immediate(1), end_addr)
+        return end_addr
+
+    def compile_not(self, f, reg):
+        # handling the edge case of `not 0`
+        f.jge(reg, Immediate(1), Immediate('$+9'))
+        f.jge(Immediate(-1), reg, Immediate('$+5'))
+        f.add(reg, Immediate(-1), reg)
+
+        f.mul(reg, Immediate(-1), reg)  # negate the value
+
+    def register_need(self, tree):
+        """
+        Returns how many registers evaluating `tree` in registers takes, or
+        None if it has to go through the stack (calls and list literals).
+        """
+        if tree.kind in ('IDENT', 'INT'):
+            return 1
+        elif tree.kind == 'expression':
+            return self.register_need(tree.children[0])
+        elif tree.kind == 'expr_logical':
+            # The left operand is dead once the jump over the right one is
+            # decided, so both can use the same registers.
+            needs = [self.register_need(x) for x in tree.children[1::2]]
+            return None if None in needs else max(needs)
+        elif tree.kind in ('expr_comparison', 'expr_add', 'expr_mul'):
+            operands = tree.children[0::2]
+        elif tree.kind == 'expr_atom':
+            suffixes = tree.children[1:]
+            if any(x.kind != 'expr_atom_index' for x in suffixes):
+                return None
+            operands = [tree.children[0]] + [x.children[0] for x in suffixes]
+        else:
+            return None
+
+        needs = [self.register_need(x) for x in operands]
+        if None in needs:
+            return None
+        # Sethi-Ullman numbering: operands are evaluated one after another,
+        # so a binary operation only needs an extra register for a tie.
+        need = needs[0]
+        for x in needs[1:]:
+            need = max(need, x) if need != x else need + 1
+        return need
+
+    def compile_register_expression(self, f, scope, tree, d):
+        # Evaluates a call-free expression into REGISTERS[d], using only
+        # REGISTERS[d:] and spilling to the stack when they run out.
+        reg = REGISTERS[d]
+        if tree.kind == 'IDENT':
+            self.get_var(f, scope, tree.text, reg)
+        elif tree.kind == 'INT':
+            f.add(Immediate(0), Immediate(int(tree.text)), reg)
+        elif tree.kind == 'expression':
+            self.compile_register_expression(f, scope, tree.children[0], d)
+        elif tree.kind == 'expr_logical':
+            def compile_left(d):
+                self.compile_register_expression(
+                    f, scope, tree.children[1], d)
+                if tree.children[0].kind == 'NOT':
+                    self.compile_not(f, REGISTERS[d])
+            compile_left(d)
+            if len(tree.children) == 4:
+                end_addr = self.compile_logical_jump(f, tree.children[2], reg)
+                start = f.size
+                self.compile_register_expression(
+                    f, scope, tree.children[3], d)
+                end_addr.intcode = f'$+{f.size - start + 1}'
+        elif tree.kind in ('expr_comparison', 'expr_add', 'expr_mul'):
+            if len(tree.children) == 3:
+                left = (self.register_need(tree.children[0]), lambda d: self.compile_register_expression(
+                    f, scope, tree.children[0], d))
+                self.compile_register_operator(
+                    f, scope, tree.children[1], left, tree.children[2], d)
+            else:
+                self.compile_register_expression(
+                    f, scope, tree.children[0], d)
+        elif tree.kind == 'expr_atom':
+            if len(tree.children) > 1:
+                # a[x][y] is (a[x])[y]
+                base = ASTNode('expr_atom', tree.children[:-1])
+                left = (self.register_need(base), lambda d: self.compile_register_expression(
+                    f, scope, base, d))
+                self.compile_register_operator(
+                    f, scope, INDEX, left, tree.children[-1].children[0], d)
+            else:
+                self.compile_register_expression(
+                    f, scope, tree.children[0], d)
+        else:
+            raise Exception(f"Unimplemented: {tree.kind}")
+
+    def compile_register_operator(self, f, scope, op, left, right_tree, d):
+        # `left` is a (register need, compile function) pair so the callers
+        # can attach `not` or an index chain to it.
+        right = (self.register_need(right_tree), lambda d: self.compile_register_expression(
+            f, scope, right_tree, d))
+        # Evaluate the operand that needs more registers first.
+        first, second = (left, right) if left[0] >= right[0] else (right, left)
+        first[1](d)
+        if second[0] < len(REGISTERS) - d:
+            second[1](d + 1)
+            held, last = REGISTERS[d], REGISTERS[d + 1]
+        else:
+            # Out of registers: keep the first operand on the stack meanwhile.
+            f.push(REGISTERS[d])
+            second[1](d)
+            f.pop(REGISTERS[d + 1])
+            held, last = REGISTERS[d + 1], REGISTERS[d]
+        a, b = (held, last) if first is left else (last, held)
+        scratch = REGISTERS[d + 2] if d + 2 < len(REGISTERS) else None
+        self.compile_operator(f, op, a, b, REGISTERS[d], scratch=scratch)
+
     def compile_expression(self, f, scope, tree, stack_size_neg):
+        if self.optimize >= 1:
+            # Anything more than a single value is cheaper in registers,
+            # as long as it does not call functions or allocate lists.
+            need = self.register_need(tree)
+            if need is not None and need > 1:
+                self.compile_register_expression(f, scope, tree, 0)
+                f.push('r0')
+                return
+
         if tree.kind == 'expression':
             self.compile_expression(f, scope, tree.children[0], stack_size_neg)
         elif tree.kind == 'expr_logical':
             self.compile_expression(f, scope, tree.children[1], stack_size_neg)
             if tree.children[0].kind == 'NOT':
                 f.pop('r0')
-
-                # handling the edge case of `not 0`
-                f.jge('r0', Immediate(1), '$+9')
-                f.jge(Immediate(-1), 'r0', '$+5')
-                f.add('r0', Immediate(-1), 'r0')
-
-                f.mul('r0', Immediate(-1), 'r0')  # negate the value
+                self.compile_not(f, 'r0')
                 f.push('r0')
             if len(tree.children) == 4:
-                op = tree.children[2]
+                f.pop('r0')
+                end_addr = self.compile_logical_jump(f, tree.children[2], 'r0')
+                start = f.size
                 self.compile_expression(
                     f, scope, tree.children[3], stack_size_neg)
-                f.pop('r1')
                 f.pop('r0')
-                if op.kind == 'AND':
-                    # multipication works as a logical AND.
-                    f.mul('r0', 'r1', 'r0')
-                elif op.kind == 'OR':
-                    # addition works as a logical OR.
-                    f.add('r0', 'r1', 'r0')
-                else:
-                    raise Exception(f"Unimplemented: {op}")
+                end_addr.intcode = f'$+{f.size - start + 1}'
                 f.push('r0')
         elif tree.kind == 'expr_comparison':
             self.compile_expression(f, scope, tree.children[0], stack_size_neg)
@@ -91,38 +295,7 @@ class Compiler:
                     f, scope, tree.children[2], stack_size_neg)
                 f.pop('r1')
                 f.pop('r0')
-                if op.kind == 'LT':
-                    # if -r0 + r1 is a positive integer, true.
-                    f.mul('r0', Immediate(-1), 'r0')
-                    f.add('r0', 'r1', 'r0')
-                elif op.kind == 'LTE':
-                    # if -r0 + (r1 + 1) is a positive integer, true.
-                    f.add('r1', Immediate(1), 'r1')
-                    f.mul('r0', Immediate(-1), 'r0')
-                    f.add('r0', 'r1', 'r0')
-                elif op.kind == 'EQ':
-                    f.add(Immediate(0), Immediate(1), 'r2')
-                    f.jge('r0', 'r1', Immediate('$+5'))
-                    f.add(Immediate(0), Immediate(0), 'r2')
-                    f.jge('r1', 'r0', Immediate('$+5'))
-                    f.add(Immediate(0), Immediate(0), 'r2')
-                    f.add('r2', Immediate(0), 'r0')
-                elif op.kind == 'NEQ':
-                    f.add(Immediate(0), Immediate(0), 'r2')
-                    f.jge('r0', 'r1', Immediate('$+5'))
-                    f.add(Immediate(0), Immediate(1), 'r2')
-                    f.jge('r1', 'r0', Immediate('$+5'))
-                    f.add(Immediate(0), Immediate(1), 'r2')
-                    f.add('r2', Immediate(0), 'r0')
-                elif op.kind == 'GT':
-                    f.mul('r1', Immediate(-1), 'r1')
-                    f.add('r0', 'r1', 'r0')
-                elif op.kind == 'GTE':
-                    f.add('r0', Immediate(1), 'r0')
-                    f.mul('r1', Immediate(-1), 'r1')
-                    f.add('r0', 'r1', 'r0')
-                else:
-                    raise Exception(f"Unimplemented: {op}")
+                self.compile_operator(f, op, 'r0', 'r1', 'r0', scratch='r2')
                 f.push('r0')
         elif tree.kind == 'expr_add':
             self.compile_expression(f, scope, tree.children[0], stack_size_neg)
@@ -132,13 +305,7 @@ class Compiler:
                     f, scope, tree.children[2], stack_size_neg)
                 f.pop('r1')
                 f.pop('r0')
-                if op.kind == 'ADD':
-                    f.add('r0', 'r1', 'r0')
-                elif op.kind == 'SUB':
-                    f.mul('r1', Immediate(-1), 'r1')
-                    f.add('r0', 'r1', 'r0')
-                else:
-                    raise Exception(f"Unimplemented: {op}")
+                self.compile_operator(f, op, 'r0', 'r1', 'r0')
                 f.push('r0')
         elif tree.kind == 'expr_mul':
             self.compile_expression(f, scope, tree.children[0], stack_size_neg)
@@ -148,12 +315,7 @@ class Compiler:
                     f, scope, tree.children[2], stack_size_neg)
                 f.pop('r1')
                 f.pop('r0')
-                if op.kind == 'MUL':
-                    f.mul('r0', 'r1', 'r0')
-                elif op.kind == 'DIV':
-                    f.div('r0', 'r1', 'r0')
-                else:
-                    raise Exception(f"Unimplemented: {op}")
+                self.compile_operator(f, op, 'r0', 'r1', 'r0')
                 f.push('r0')
         elif tree.kind == 'expr_atom':
             if len(tree.children) > 1:
@@ -186,32 +348,139 @@ class Compiler:
                         f, scope, ind.children[0], stack_size_neg)
                     f.pop('r1')
                     f.pop('r0')
-                    f.add('r0', 'r1', '$+3')  # r0 = base, r1 = offset
-                    f.add(Immediate(0), 0, 'r0')
+                    self.compile_operator(f, INDEX, 'r0', 'r1', 'r0')
                     f.push('r0')
         elif tree.kind == 'IDENT':
             self.get_var(f, scope, tree.text, 'r0')
             f.push('r0')
         elif tree.kind == 'INT':
             f.push(Immediate(int(tree.text)))
+        elif tree.kind == 'expr_atom_list' and self.is_constant_list(tree):
+            f.push(Immediate(self.static_list(tree)))
         elif tree.kind == 'expr_atom_list':
-            # Allocate stack for the value
+            # Allocate stack for the value and its length, which is stored
+            # right before the first element (see the len builtin).
             var = -stack_size_neg.intcode
-            stack_size_neg.intcode -= len(tree.children)
+            stack_size_neg.intcode -= len(tree.children) + 1
             for i, elm in enumerate(reversed(tree.children)):
                 self.compile_expression(f, scope, elm, stack_size_neg)
                 f.pop('r0')
                 f.write_local(var + i, 'r0')
+            f.write_local(var + len(tree.children), Immediate(len(tree.children)))
             # Get the start address of the array
-            f.add('bp', Immediate(-(var + len(tree.children))), 'r0')
+            f.add('bp', Immediate(-(var + len(tree.children) + 1)), 'r0')
             f.push('r0')
         else:
             raise Exception(f"Unimplemented: {tree.kind}")
 
-    def compile_statement(self, f, scope, tree, stack_size_neg):
+    def is_constant_list(self, tree, constants={}):
+        # Whether every element of a list literal is known at compile time:
+        # an integer, a name in `constants` or a constant list.
+        for elm in tree.children:
+            value = optimizer.atom(elm)
+            if value is None:
+                return False
+            if value.kind == 'expr_atom_list':
+                if not self.is_constant_list(value, constants):
+                    return False
+            elif value.kind == 'IDENT':
+                if value.text not in constants:
+                    return False
+            elif value.kind != 'INT':
+                return False
+        return True
+
+    def static_list(self, tree, constants={}):
+        # Places a constant list literal in the data section, prefixed with
+        # its length, and returns the address of its first element. Every
+        # evaluation of the literal refers to the same array.
+        header = self.code_generator.data.obtain(1)
+        header.content[0] = len(tree.children)
+        elements = self.code_generator.data.obtain(len(tree.children))
+        for i, elm in enumerate(tree.children):
+            value = optimizer.atom(elm)
+            if value.kind == 'expr_atom_list':
+                elements.write(i, self.static_list(value, constants))
+            elif value.kind == 'IDENT':
+                elements.write(i, constants[value.text])
+            else:
+                elements.write(i, int(value.text))
+        return elements
+
+    def call_atom(self, tree):
+        # Returns the expr_atom if the expression is nothing but a call.
+        while tree.kind != 'expr_atom':
+            if tree.kind == 'expr_logical' and tree.children[0].kind == 'NOT':
+                return None
+            if len(tree.children) != (2 if tree.kind == 'expr_logical' else 1):
+                return None
+            tree = tree.children[-1]
+        if len(tree.children) == 2 and tree.children[1].kind == 'expr_atom_func_args':
+            return tree
+        return None
+
+    def compile_tail_call(self, f, scope, tree, stack_size_neg):
+        # Calls the function in tree (an expr_atom) by reusing the current
+        # frame: the new args overwrite ours and the callee returns straight
+        # to our caller. Returns False if that is not possible.
+        func_args = tree.children[1].children
+        n_params = sum(type(x) == str for x in scope.values())
+        if len(func_args) > n_params:
+            return False  # our caller only made room for n_params args
+
+        # Args are pushed in reverse order
+        for arg in reversed(func_args):
+            self.compile_expression(f, scope, arg, stack_size_neg)
+        self.compile_expression(f, scope, tree.children[0], stack_size_neg)
+        f.pop('r0')
+
+        for i in range(len(func_args)):
+            f.read_stack(i, 'r1')
+            f.write_stack(i, 'r1', from_='bp')
+
+        self.compile_frame_exit(f)
+        f.jge(Immediate(0), Immediate(0), 'r0')
+        return True
+
+    def compile_frame_entry(self, f, stack_size_neg):
+        # Save and set bp and allocate
+        if self.target == 'relative':
+            # Set the relative base to the new bp, and keep bp - caller's bp
+            # below the return address to undo that on the way out.
+            sp_offset = Immediate(0)
+            f.mul('bp', Immediate(-1), 'r1')
+            f.add(Immediate(1), 'sp', 'bp')  # 1 = ret addr
+            f.add('bp', 'r1', 'r1')
+            f.arb('r1')
+            f.write_stack(-2, 'r1', from_='bp')
+            f.add('sp', sp_offset, 'sp')
+            return sp_offset
+        f.push('bp')
+        f.add(Immediate(2), 'sp', 'bp')  # 2 = bp + ret addr
+        f.add('sp', stack_size_neg, 'sp')
+        return None
+
+    def compile_frame_exit(self, f):
+        # Unwind to the state right after our caller's call: sp right below
+        # the return address, and the caller's bp.
+        if self.target == 'relative':
+            f.add('bp', Immediate(-1), 'sp')
+            f.mul(Relative(-1), Immediate(-1), 'r1')
+            f.add('bp', 'r1', 'bp')
+            f.arb('r1')
+        else:
+            f.read_stack(-2, 'r1', from_='bp')
+            f.add('bp', Immediate(-1), 'sp')
+            f.add('r1', Immediate(0), 'bp')
+
+    def compile_statement(self, f, scope, tree, stack_size_neg, tail=False):
         if tree.kind == 'statement':
-            self.compile_statement(f, scope, tree.children[0], stack_size_neg)
+            self.compile_statement(
+                f, scope, tree.children[0], stack_size_neg, tail=tail)
         elif tree.kind == 'expression':
+            call = self.call_atom(tree) if tail else None
+            if call and self.compile_tail_call(f, scope, call, stack_size_neg):
+                return
             self.compile_expression(f, scope, tree, stack_size_neg)
             # Clean up what the expression pushed.
             # Pop it into r0 so the last expression can be a return value
@@ -224,13 +493,20 @@ class Compiler:
             if len(tree.children[1]):  # a[x][y]... = expr
                 self.get_var(f, scope, var, 'r0')
                 f.push('r0')
-                for ind in tree.children[1]:
+                *outer, last = tree.children[1]
+                for ind in outer:
                     self.compile_expression(
                         f, scope, ind.children[0], stack_size_neg)
                     f.pop('r1')
                     f.pop('r0')
-                    f.add('r0', 'r1', '$+3')
-                    f.add(Immediate(0), Immediate(0), 'r0')
+                    self.compile_operator(f, INDEX, 'r0', 'r1', 'r0')
+                    f.push('r0')
+                # Only the last index is an address to write to.
+                self.compile_expression(
+                    f, scope, last.children[0], stack_size_neg)
+                f.pop('r1')
+                f.pop('r0')
+                f.add('r0', 'r1', 'r0')
                 f.pop('r1')  # value to assign
                 f.add(Immediate(0), 'r0', '$+4')
                 f.add(Immediate(0), 'r1', 0)
@@ -252,17 +528,35 @@ class Compiler:
             f.jge(Immediate(0), 'r0', else_addr)
 
             # if block
-            start = f.address.size
-            for stat in tree.children[1]:
-                self.compile_statement(f, scope, stat, stack_size_neg)
+            start = f.size
+            for i, stat in enumerate(tree.children[1]):
+                self.compile_statement(f, scope, stat, stack_size_neg,
+                                       tail=tail and i == len(tree.children[1]) - 1)
             f.jge(Immediate(0), Immediate(0), end_addr)
 
             # else block
-            else_addr.intcode = f'$+{f.address.size - start + 1}'
-            start = f.address.size
-            for stat in tree.children[2]:
+            else_addr.intcode = f'$+{f.size - start + 1}'
+            start = f.size
+            for i, stat in enumerate(tree.children[2]):
+                self.compile_statement(f, scope, stat, stack_size_neg,
+                                       tail=tail and i == len(tree.children[2]) - 1)
+            end_addr.intcode = f'$+{f.size - start + 1}'
+        elif tree.kind == 'while_statement':
+            # The condition is at the bottom of the loop, so an iteration
+            # ends with a single conditional jge back to the body.
+            cond_addr = Immediate(0)
+            f.jge(Immediate(0), Immediate(0), cond_addr)
+
+            # loop body
+            start = f.size
+            for stat in tree.children[1]:
                 self.compile_statement(f, scope, stat, stack_size_neg)
-            end_addr.intcode = f'$+{f.address.size - start + 1}'
+
+            # condition: loop while it is > 0
+            cond_addr.intcode = f'$+{f.size - start + 1}'
+            self.compile_expression(f, scope, tree.children[0], stack_size_neg)
+            f.pop('r0')
+            f.jge('r0', Immediate(1), Immediate(f'$+{start - f.size - 3}'))
         else:
             raise Exception(f"Unimplemented: {tree.kind}")
 
@@ -275,21 +569,25 @@ class Compiler:
         stack_size_neg = Immediate(0)
         local_scope = self.local_scope[name]
 
-        # Save and set bp and allocate
-        f.push('bp')
-        f.add(Immediate(2), 'sp', 'bp')  # 2 = bp + ret addr
-        f.add('sp', stack_size_neg, 'sp')
+        sp_offset = self.compile_frame_entry(f, stack_size_neg)
+
+        # Calls in tail position reuse the frame, unless a list literal
+        # lives in it that the callee could still be pointing at.
+        tail = self.optimize >= 1 and not contains(stats, 'expr_atom_list')
+        for i, stat in enumerate(stats):
+            self.compile_statement(f, local_scope, stat, stack_size_neg,
+                                   tail=tail and i == len(stats) - 1)
 
-        for stat in stats:
-            self.compile_statement(f, local_scope, stat, stack_size_neg)
+        if sp_offset is not None:
+            # The saved slot below the return address, then the frame
+            sp_offset.intcode = stack_size_neg.intcode - 1
 
         # clean up and ret
-        f.add('sp', Immediate(-stack_size_neg.intcode), 'sp')
-        f.pop('bp')
+        self.compile_frame_exit(f)
         f.ret('r0')
 
     def add_builtin(self):
-        # Memory section access (stack, text, data, heap)
+        # Memory section access (stack, text, data, heap, end of heap)
         self.global_scope['_sections'] = GlobalVariableBuilder(
             self.code_generator.section_info)
 
@@ -300,9 +598,32 @@ class Compiler:
         f.out('r0')
         f.ret('r0')
 
-    def compile(self, ast):
+        # len(x): arrays are prefixed with their length
+        name = 'len'
+        f = self.global_scope[name] = self.code_generator.new_function()
+        f.read_stack(1, 'r0')
+        f.add('r0', Immediate(-1), '$+3')
+        f.add(Immediate(0), 0, 'r0')
+        f.ret('r0')
+
+    def add_runtime(self, ast):
+        # Programs that use alloc/free, and do not define their own, are
+        # compiled along with the runtime.
+        defined = {x.children[0].text for x in ast.children}
+        used = set(identifiers(ast.children))
+        if not {'alloc', 'free'} & used or {'alloc', 'free'} & defined:
+            return ast
+        with open(RUNTIME) as f:
+            runtime = Parser().parse(f.read())
+        return ASTNode('program', runtime.children + ast.children)
+
+    def compile(self, ast, binary=False):
         self.reset()
         self.add_builtin()
+        ast = self.add_runtime(ast)
+
+        if self.optimize >= 1:
+            ast = optimizer.optimize(ast)
 
         # Register all functions/global vars first so it can reference each other regardless of the order of definitions
         for stat in ast.children:
@@ -317,7 +638,21 @@ class Compiler:
                 name, value = stat.children
                 self.global_scope[name.text] = self.code_generator.data.obtain(
                     1)
-                self.global_scope[name.text].content[0] = int(value.text)
+                if value.kind == 'INT':
+                    self.global_scope[name.text].content[0] = int(value.text)
+
+        # Global lists can refer to the initial values of integer globals
+        constants = {
+            stat.children[0].text: int(stat.children[1].text) for stat in ast.children
+            if stat.kind == 'global_variable_definition' and stat.children[1].kind == 'INT'}
+        for stat in ast.children:
+            if stat.kind == 'global_variable_definition' and stat.children[1].kind == 'expr_atom_list':
+                name, value = stat.children
+                if not self.is_constant_list(value, constants):
+                    raise Exception(
+                        f'Only constants are supported in a global list: {name.text}')
+                self.global_scope[name.text].write(
+                    0, self.static_list(value, constants))
 
         # Compile all functions
         for func_def in [x for x in ast.children if x.kind == 'function_definition']:
@@ -329,8 +664,12 @@ class Compiler:
 
         # Set up entrypoint
         entrypoint = self.code_generator.new_function()
+        if self.target == 'relative':
+            entrypoint.arb('bp')  # the relative base starts at 0
         entrypoint.call(Immediate(self.global_scope['main'].address))
         entrypoint.halt()
         self.code_generator.set_entrypoint(entrypoint.address)
 
+        if binary:
+            return self.code_generator.generate_binary()
         return self.code_generator.generate()
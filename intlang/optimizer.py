@@ -0,0 +1,195 @@
+from intlang.parser import ASTNode, Token
+
+# Expression node kinds from the outermost to the innermost. A node of any of
+# these kinds with a single child is a plain wrapper around that child.
+EXPRESSION_KINDS = ['expression', 'expr_logical',
+                    'expr_comparison', 'expr_add', 'expr_mul', 'expr_atom']
+
+
+def wrap(value):
+    # Intcode cells are signed 64-bit integers.
+    return (value + (1 << 63)) % (1 << 64) - (1 << 63)
+
+
+def divide(a, b):
+    # Division truncates toward zero, as in C.
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+
+def logical_not(value):
+    # `not 0` is 1, anything else is negated; see Compiler.compile_not.
+    return 1 if value == 0 else -value
+
+
+def evaluate(op, a, b):
+    """
+    Evaluates a binary operator the way the compiled code does, or returns
+    None if it cannot be folded.
+    """
+    if op == 'ADD':
+        return wrap(a + b)
+    elif op == 'SUB':
+        return wrap(a - b)
+    elif op == 'MUL':
+        return wrap(a * b)
+    elif op == 'DIV':
+        if b == 0 or (a == -(1 << 63) and b == -1):
+            return None  # leave the runtime behavior to the VM
+        return divide(a, b)
+    elif op == 'LT':
+        return wrap(b - a)
+    elif op == 'LTE':
+        return wrap(b + 1 - a)
+    elif op == 'EQ':
+        return 1 if a == b else 0
+    elif op == 'NEQ':
+        return 0 if a == b else 1
+    elif op == 'GT':
+        return wrap(a - b)
+    elif op == 'GTE':
+        return wrap(a + 1 - b)
+    return None
+
+
+def atom(tree):
+    # Returns the value (a token or a list literal) that a tree of plain
+    # wrappers is, or None if the tree is more than that.
+    while isinstance(tree, ASTNode) and tree.kind in EXPRESSION_KINDS:
+        if tree.kind == 'expr_logical':
+            if len(tree.children) != 2 or tree.children[0].kind == 'NOT':
+                return None
+            tree = tree.children[1]
+        elif len(tree.children) == 1:
+            tree = tree.children[0]
+        else:
+            return None
+    return tree
+
+
+def int_value(tree):
+    # Returns the value of a tree that is an integer literal, or None.
+    tree = atom(tree)
+    if tree is not None and tree.kind == 'INT':
+        return int(tree.text)
+    return None
+
+
+def literal(kind, value):
+    # Builds a node of `kind` that is just the integer literal `value`.
+    node = Token('INT', str(value))
+    for k in reversed(EXPRESSION_KINDS[EXPRESSION_KINDS.index(kind):]):
+        if k == 'expr_logical':
+            node = ASTNode(k, [Token(None, None), node])
+        else:
+            node = ASTNode(k, [node])
+    return node
+
+
+def fold(tree, constants):
+    """
+    Folds constant sub-expressions of an expression tree and substitutes
+    the integer constants in `constants` (a name -> int dict).
+    """
+    if isinstance(tree, Token):
+        if tree.kind == 'IDENT' and tree.text in constants:
+            return Token('INT', str(constants[tree.text]), tree.line, tree.column)
+        return tree
+
+    children = [fold(x, constants) if isinstance(x, ASTNode) or x.kind == 'IDENT' else x
+                for x in tree.children]
+
+    if tree.kind == 'expr_logical':
+        negate, left = children[0], children[1]
+        if negate.kind == 'NOT':
+            value = int_value(left)
+            if value is not None:
+                negate = Token(None, None)
+                left = literal('expr_comparison', logical_not(value))
+        children = [negate, left] + children[2:]
+        if len(children) == 4 and negate.kind != 'NOT':
+            # A constant left operand decides which operand is the value.
+            a = int_value(left)
+            if a is not None:
+                if (a > 0) == (children[2].kind == 'AND'):
+                    return children[3]
+                return literal('expr_logical', a)
+    elif tree.kind in ('expr_comparison', 'expr_add', 'expr_mul') and len(children) == 3:
+        left, op, right = children
+        a, b = int_value(left), int_value(right)
+        if a is not None and b is not None:
+            value = evaluate(op.kind, a, b)
+            if value is not None:
+                return literal(tree.kind, value)
+        # x + 0, x - 0, 0 + x, x * 1, x / 1, 1 * x
+        if op.kind in ('ADD', 'SUB') and b == 0 or op.kind in ('MUL', 'DIV') and b == 1:
+            return ASTNode(tree.kind, [left])
+        if op.kind == 'ADD' and a == 0 or op.kind == 'MUL' and a == 1:
+            return right
+    return ASTNode(tree.kind, children)
+
+
+def fold_statement(tree, constants):
+    if tree.kind == 'statement':
+        return ASTNode('statement', [fold_statement(tree.children[0], constants)])
+    elif tree.kind == 'assignment':
+        ident, indices, expr = tree.children
+        return ASTNode('assignment', [
+            ident, [fold(x, constants) for x in indices], fold(expr, constants)])
+    elif tree.kind == 'if_statement':
+        expr, true_body, false_body = tree.children
+        return ASTNode('if_statement', [
+            fold(expr, constants),
+            [fold_statement(x, constants) for x in true_body],
+            [fold_statement(x, constants) for x in false_body]])
+    elif tree.kind == 'while_statement':
+        expr, body = tree.children
+        return ASTNode('while_statement', [
+            fold(expr, constants), [fold_statement(x, constants) for x in body]])
+    return fold(tree, constants)
+
+
+def assigned_names(stats):
+    for stat in stats:
+        if stat.kind == 'statement':
+            yield from assigned_names(stat.children)
+        elif stat.kind == 'assignment':
+            ident, indices, _ = stat.children
+            if not indices:
+                yield ident.text
+        elif stat.kind == 'if_statement':
+            yield from assigned_names(stat.children[1])
+            yield from assigned_names(stat.children[2])
+        elif stat.kind == 'while_statement':
+            yield from assigned_names(stat.children[1])
+
+
+def optimize(program):
+    """
+    Constant-folds a program: integer globals that are never assigned are
+    substituted, and constant sub-expressions are evaluated at compile time
+    with the same semantics as the compiled code.
+    """
+    assigned = set()
+    for definition in program.children:
+        if definition.kind == 'function_definition':
+            assigned.update(assigned_names(definition.children[2]))
+
+    constants = {}
+    for definition in program.children:
+        if definition.kind == 'global_variable_definition':
+            name, value = definition.children
+            if name.text not in assigned and value.kind == 'INT':
+                constants[name.text] = int(value.text)
+
+    definitions = []
+    for definition in program.children:
+        if definition.kind == 'function_definition':
+            name, params, body = definition.children
+            # Parameters shadow globals
+            scope = {k: v for k, v in constants.items()
+                     if k not in {x.text for x in params}}
+            definition = ASTNode('function_definition', [
+                name, params, [fold_statement(x, scope) for x in body]])
+        definitions.append(definition)
+    return ASTNode('program', definitions)
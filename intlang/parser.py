@@ -1,7 +1,7 @@
 from collections import namedtuple
 import re
 
-Token = namedtuple('Token', 'kind text')
+Token = namedtuple('Token', 'kind text line column', defaults=(None, None))
 ASTNode = namedtuple('ASTNode', 'kind children')
 
 
@@ -9,6 +9,33 @@ class NotMatched(Exception):
     pass
 
 
+def memoize(rule):
+    # Packrat memoization: cache the result (or failure) of a rule by the
+    # cursor position it started at, when the parser runs in packrat mode.
+    # Only the rules that backtracking alternatives re-enter at the same
+    # position are worth the bookkeeping (expressions and index suffixes).
+    def memoized_rule(self):
+        if self.memo is None:
+            return rule(self)
+        key = (rule.__name__, self.pos)
+        cached = self.memo.get(key)
+        if cached is not None:
+            result, end = cached
+            if isinstance(result, NotMatched):
+                raise result.with_traceback(None)
+            self.pos = end
+            return result
+        start = self.pos
+        try:
+            result = rule(self)
+        except NotMatched as e:
+            self.memo[key] = (e, start)
+            raise
+        self.memo[key] = (result, self.pos)
+        return result
+    return memoized_rule
+
+
 class Parser:
     TOKENS = {
         'AND': r'and',
@@ -17,6 +44,7 @@ class Parser:
         'FN': r'fn',
         'IF': r'if',
         'ELSE': r'else',
+        'WHILE': r'while',
         'END': r'end',
         'INT': r'-?[0-9]+',
         'IDENT': r'[a-zA-Z_][a-zA-Z0-9_]*',
@@ -38,117 +66,148 @@ class Parser:
         'IGNORE': r'[ \t\r\n]|#.*'
     }
 
-    def lex(self, source):
-        tokens = []
-        while source:
-            for k, v in self.TOKENS.items():
-                match = re.findall(f'^{v}', source)
-                if match:
-                    if k != 'IGNORE':
-                        tokens.append(Token(k, match[0]))
-                    source = source[len(match[0]):]
-                    break
-            else:
-                near = source.split('\n')[0]
-                raise NotMatched(f"Unexpected token near {near}")
-        return tokens
+    MASTER_PATTERN = re.compile(
+        '|'.join(f'(?P<{k}>{v})' for k, v in TOKENS.items()))
 
-    def take(self, tokens):
-        try:
-            return tokens.pop(0)
-        except IndexError:
-            return Token('EOF', '')
+    def __init__(self, packrat=False):
+        self.packrat = packrat
+        self.memo = None
 
-    def peek(self, tokens):
+    def lex(self, source):
+        # Alternatives are tried in the order of TOKENS, so the first
+        # matching kind wins (e.g. `and` over IDENT), same as before.
+        match = self.MASTER_PATTERN.match
+        pos = 0
+        line = 1
+        line_start = 0
+        while pos < len(source):
+            m = match(source, pos)
+            if m is None:
+                near = source[pos:].split('\n')[0]
+                raise NotMatched(
+                    f"Unexpected token near {near} (line {line}, column {pos - line_start + 1})")
+            kind = m.lastgroup
+            text = m.group()
+            if kind != 'IGNORE':
+                yield Token(kind, text, line, pos - line_start + 1)
+            elif text == '\n':
+                line += 1
+                line_start = m.end()
+            pos = m.end()
+
+    def take(self):
+        token = self.peek()
+        if self.pos < len(self.tokens):
+            self.pos += 1
+        return token
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return Token('EOF', '')
+
+    def attempt(self, rule):
+        # Backtracking only needs to rewind the cursor.
+        start = self.pos
         try:
-            return tokens[0]
-        except IndexError:
-            return Token('EOF', '')
+            return rule()
+        except NotMatched:
+            self.pos = start
+            raise
 
     def parse(self, source):
-        tokens = self.lex(source)
-        _, tree = self.parse_program(tokens)
-        return tree
+        self.tokens = list(self.lex(source))
+        self.pos = 0
+        self.memo = {} if self.packrat else None
+        try:
+            return self.parse_program()
+        finally:
+            self.memo = None
 
-    def parse_program(self, tokens):
-        tokens = list(tokens)
+    def parse_program(self):
         program = []
-        while len(tokens) > 0:
+        while self.pos < len(self.tokens):
+            # Nothing before the current definition can be reused, so the
+            # memo table only ever holds entries for one definition.
+            if self.memo is not None:
+                self.memo.clear()
             try:
-                tokens, tree = self.parse_global_variable_definition(tokens)
-                program.append(tree)
+                program.append(self.attempt(
+                    self.parse_global_variable_definition))
             except NotMatched:
                 try:
-                    tokens, tree = self.parse_function_definition(tokens)
-                    program.append(tree)
+                    program.append(self.attempt(
+                        self.parse_function_definition))
                 except NotMatched:
                     raise NotMatched(
                         "Expected a global variable or function definition")
-        return tokens, ASTNode('program', program)
+        return ASTNode('program', program)
 
-    def parse_statement(self, tokens):
-        tokens = list(tokens)
+    def parse_statement(self):
         args = []
         try:
-            tokens, tree = self.parse_assignment(tokens)
-            args.append(tree)
+            args.append(self.attempt(self.parse_assignment))
         except NotMatched:
             try:
-                tokens, tree = self.parse_expression(tokens)
-                args.append(tree)
+                args.append(self.attempt(self.parse_expression))
             except NotMatched:
                 try:
-                    tokens, tree = self.parse_if_statement(tokens)
-                    args.append(tree)
+                    args.append(self.attempt(self.parse_if_statement))
                 except NotMatched:
-                    raise NotMatched(
-                        "Expected expression/assignment/if")
-        return tokens, ASTNode('statement', args)
-
-    def parse_global_variable_definition(self, tokens):
-        tokens = list(tokens)
-        if self.peek(tokens).kind == 'IDENT':
-            ident = self.take(tokens)
-            if self.take(tokens).kind == 'EQ':
-                if self.peek(tokens).kind == 'INT':
-                    value = self.take(tokens)
-                    return tokens, ASTNode('global_variable_definition', [ident, value])
+                    try:
+                        args.append(self.attempt(self.parse_while_statement))
+                    except NotMatched:
+                        raise NotMatched(
+                            "Expected expression/assignment/if/while")
+        return ASTNode('statement', args)
+
+    def parse_statements(self):
+        stats = []
+        while True:
+            try:
+                stats.append(self.attempt(self.parse_statement))
+            except NotMatched:
+                return stats
+
+    def parse_global_variable_definition(self):
+        if self.peek().kind == 'IDENT':
+            ident = self.take()
+            if self.take().kind == 'EQ':
+                if self.peek().kind == 'INT':
+                    value = self.take()
+                    return ASTNode('global_variable_definition', [ident, value])
+                elif self.peek().kind == 'LSQUARE':
+                    value = self.parse_expr_atom_list()
+                    return ASTNode('global_variable_definition', [ident, value])
                 else:
                     raise NotMatched(
-                        'Only INT is supported for a global variable value')
+                        'Only INT or a list is supported for a global variable value')
             else:
                 raise NotMatched('Expected =')
         else:
             raise NotMatched('Expected a global variable name')
 
-    def parse_function_definition(self, tokens):
-        tokens = list(tokens)
-        if self.take(tokens).kind == 'FN':
-            func_name = self.take(tokens)
+    def parse_function_definition(self):
+        if self.take().kind == 'FN':
+            func_name = self.take()
             if func_name.kind == 'IDENT':
-                if self.take(tokens).kind == 'LPAREN':
+                if self.take().kind == 'LPAREN':
                     params = []
-                    while self.peek(tokens).kind != 'RPAREN':
-                        param_name = self.take(tokens)
+                    while self.peek().kind != 'RPAREN':
+                        param_name = self.take()
                         if param_name.kind == 'IDENT':
                             params.append(param_name)
                         else:
                             raise NotMatched(
                                 "Expected a parameter name in fn(...)")
-                        if self.peek(tokens).kind == 'COMMA':
-                            self.take(tokens)
-                    self.take(tokens)
-
-                    func_body = []
-                    while True:
-                        try:
-                            tokens, tree = self.parse_statement(tokens)
-                            func_body.append(tree)
-                        except NotMatched:
-                            break
-                    if self.peek(tokens).kind == 'END':
-                        self.take(tokens)
-                        return tokens, ASTNode('function_definition', [func_name, params, func_body])
+                        if self.peek().kind == 'COMMA':
+                            self.take()
+                    self.take()
+
+                    func_body = self.parse_statements()
+                    if self.peek().kind == 'END':
+                        self.take()
+                        return ASTNode('function_definition', [func_name, params, func_body])
                     else:
                         raise NotMatched(
                             "Expected end after the function body")
@@ -159,50 +218,48 @@ class Parser:
         else:
             raise NotMatched("Expected fn")
 
-    def parse_if_statement(self, tokens):
-        tokens = list(tokens)
-        if self.take(tokens).kind == 'IF':
-            tokens, expr = self.parse_expression(tokens)
-            true_body = []
+    def parse_if_statement(self):
+        if self.take().kind == 'IF':
+            expr = self.parse_expression()
+            true_body = self.parse_statements()
             false_body = []
-            while True:
-                try:
-                    tokens, tree = self.parse_statement(tokens)
-                    true_body.append(tree)
-                except NotMatched:
-                    break
 
-            if self.peek(tokens).kind == 'ELSE':
-                self.take(tokens)
-                while True:
-                    try:
-                        tokens, tree = self.parse_statement(tokens)
-                        false_body.append(tree)
-                    except NotMatched:
-                        break
+            if self.peek().kind == 'ELSE':
+                self.take()
+                false_body = self.parse_statements()
 
-            if self.take(tokens).kind == 'END':
-                return tokens, ASTNode('if_statement', [expr, true_body, false_body])
+            if self.take().kind == 'END':
+                return ASTNode('if_statement', [expr, true_body, false_body])
             else:
                 raise NotMatched('Expected end')
         else:
             raise NotMatched('Expected if')
 
-    def parse_assignment(self, tokens):
-        tokens = list(tokens)
-        ident = self.take(tokens)
+    def parse_while_statement(self):
+        if self.take().kind == 'WHILE':
+            expr = self.parse_expression()
+            body = self.parse_statements()
+
+            if self.take().kind == 'END':
+                return ASTNode('while_statement', [expr, body])
+            else:
+                raise NotMatched('Expected end')
+        else:
+            raise NotMatched('Expected while')
+
+    def parse_assignment(self):
+        ident = self.take()
         if ident.kind == 'IDENT':
             indices = []
             while True:
                 try:
-                    tokens, tree = self.parse_expr_atom_index(tokens)
-                    indices.append(tree)
+                    indices.append(self.attempt(self.parse_expr_atom_index))
                 except NotMatched:
                     break
-            if self.take(tokens).kind == 'EQ':
+            if self.take().kind == 'EQ':
                 try:
-                    tokens, tree = self.parse_expression(tokens)
-                    return tokens, ASTNode('assignment', [ident, indices, tree])
+                    tree = self.parse_expression()
+                    return ASTNode('assignment', [ident, indices, tree])
                 except NotMatched:
                     raise NotMatched("Expected an expression after ... =")
             else:
@@ -210,155 +267,132 @@ class Parser:
         else:
             raise NotMatched("Expected an identifier in an assignment")
 
-    def parse_expression(self, tokens):
-        tokens = list(tokens)
-        tokens, tree = self.parse_expr_logical(tokens)
-        return tokens, ASTNode("expression", [tree])
+    @memoize
+    def parse_expression(self):
+        return ASTNode("expression", [self.parse_expr_logical()])
 
-    def parse_expr_logical(self, tokens):
-        tokens = list(tokens)
+    def parse_expr_logical(self):
         expr_logical = []
 
-        if self.peek(tokens).kind == 'NOT':
-            expr_logical.append(self.take(tokens))
+        if self.peek().kind == 'NOT':
+            expr_logical.append(self.take())
         else:
             expr_logical.append(Token(None, None))
 
-        tokens, tree = self.parse_expr_comparison(tokens)
-        expr_logical.append(tree)
+        expr_logical.append(self.parse_expr_comparison())
 
-        op = self.peek(tokens)
+        op = self.peek()
         if op.kind in ('AND', 'OR'):
-            self.take(tokens)
-            tokens, tree = self.parse_expr_logical(tokens)
+            self.take()
+            tree = self.parse_expr_logical()
             expr_logical.append(op)
             expr_logical.append(tree)
-        return tokens, ASTNode('expr_logical', expr_logical)
+        return ASTNode('expr_logical', expr_logical)
 
-    def parse_expr_comparison(self, tokens):
-        tokens = list(tokens)
-        expr_comparison = []
-        tokens, tree = self.parse_expr_add(tokens)
-        expr_comparison.append(tree)
+    def parse_expr_comparison(self):
+        expr_comparison = [self.parse_expr_add()]
 
-        op = self.peek(tokens)
+        op = self.peek()
         if op.kind in ('GT', 'GTE', 'EQ', 'NEQ', 'LT', 'LTE'):
-            self.take(tokens)
-            tokens, tree = self.parse_expr_comparison(tokens)
+            self.take()
+            tree = self.parse_expr_comparison()
             expr_comparison.append(op)
             expr_comparison.append(tree)
-        return tokens, ASTNode('expr_comparison', expr_comparison)
+        return ASTNode('expr_comparison', expr_comparison)
 
-    def parse_expr_add(self, tokens):
-        tokens = list(tokens)
-        expr_add = []
-        tokens, tree = self.parse_expr_mul(tokens)
-        expr_add.append(tree)
+    def parse_expr_add(self):
+        expr_add = [self.parse_expr_mul()]
 
-        op = self.peek(tokens)
+        op = self.peek()
         if op.kind in ('ADD', 'SUB'):
-            self.take(tokens)
-            tokens, tree = self.parse_expr_add(tokens)
+            self.take()
+            tree = self.parse_expr_add()
             expr_add.append(op)
             expr_add.append(tree)
-        return tokens, ASTNode('expr_add', expr_add)
+        return ASTNode('expr_add', expr_add)
 
-    def parse_expr_mul(self, tokens):
-        tokens = list(tokens)
-        expr_mul = []
-        tokens, tree = self.parse_expr_atom(tokens)
-        expr_mul.append(tree)
+    def parse_expr_mul(self):
+        expr_mul = [self.parse_expr_atom()]
 
-        op = self.peek(tokens)
+        op = self.peek()
         if op.kind in ('MUL', 'DIV'):
-            self.take(tokens)
-            tokens, tree = self.parse_expr_mul(tokens)
+            self.take()
+            tree = self.parse_expr_mul()
             expr_mul.append(op)
             expr_mul.append(tree)
-        return tokens, ASTNode('expr_mul', expr_mul)
+        return ASTNode('expr_mul', expr_mul)
 
-    def parse_expr_atom(self, tokens):
-        tokens = list(tokens)
+    def parse_expr_atom(self):
         atom = []
-        if self.peek(tokens).kind == 'LPAREN':
-            self.take(tokens)
-            tokens, tree = self.parse_expression(tokens)
-            atom.append(tree)
-            if self.take(tokens).kind != 'RPAREN':
+        if self.peek().kind == 'LPAREN':
+            self.take()
+            atom.append(self.parse_expression())
+            if self.take().kind != 'RPAREN':
                 raise NotMatched('Expected )')
-        elif self.peek(tokens).kind == 'LSQUARE':
-            tokens, tree = self.parse_expr_atom_list(tokens)
-            atom.append(tree)
-        elif self.peek(tokens).kind == 'IDENT':
-            atom.append(self.take(tokens))
-        elif self.peek(tokens).kind == 'INT':
-            atom.append(self.take(tokens))
+        elif self.peek().kind == 'LSQUARE':
+            atom.append(self.parse_expr_atom_list())
+        elif self.peek().kind == 'IDENT':
+            atom.append(self.take())
+        elif self.peek().kind == 'INT':
+            atom.append(self.take())
         else:
             raise NotMatched('Not a value')
 
         try:
-            tokens, tree = self.parse_expr_atom_func_args(tokens)
-            atom.append(tree)
+            atom.append(self.attempt(self.parse_expr_atom_func_args))
         except NotMatched:
             pass
 
         while True:
             try:
-                tokens, tree = self.parse_expr_atom_index(tokens)
-                atom.append(tree)
+                atom.append(self.attempt(self.parse_expr_atom_index))
             except NotMatched:
                 break
-        return tokens, ASTNode('expr_atom', atom)
+        return ASTNode('expr_atom', atom)
 
-    def parse_expr_atom_list(self, tokens):
-        tokens = list(tokens)
+    def parse_expr_atom_list(self):
         items = []
-        if self.take(tokens).kind == 'LSQUARE':
-            while self.peek(tokens).kind != 'RSQUARE':
+        if self.take().kind == 'LSQUARE':
+            while self.peek().kind != 'RSQUARE':
                 try:
-                    tokens, tree = self.parse_expression(tokens)
-                    items.append(tree)
+                    items.append(self.parse_expression())
                 except NotMatched:
                     raise NotMatched(
                         'Expected an expression in a list element')
 
-                if self.peek(tokens).kind == 'COMMA':
-                    self.take(tokens)
-                elif self.peek(tokens).kind == 'RSQUARE':
+                if self.peek().kind == 'COMMA':
+                    self.take()
+                elif self.peek().kind == 'RSQUARE':
                     pass
                 else:
                     raise NotMatched("Expected , or ]")
-            self.take(tokens)
-            return tokens, ASTNode('expr_atom_list', items)
+            self.take()
+            return ASTNode('expr_atom_list', items)
         else:
             raise NotMatched('Expected [')
 
-    def parse_expr_atom_func_args(self, tokens):
-        tokens = list(tokens)
+    def parse_expr_atom_func_args(self):
         args = []
-        if self.take(tokens).kind == 'LPAREN':
-            while self.peek(tokens).kind != 'RPAREN':
-                tokens, tree = self.parse_expression(tokens)
-                args.append(tree)
-                if self.peek(tokens).kind == 'COMMA':
-                    self.take(tokens)
-                elif self.peek(tokens).kind == 'RPAREN':
+        if self.take().kind == 'LPAREN':
+            while self.peek().kind != 'RPAREN':
+                args.append(self.parse_expression())
+                if self.peek().kind == 'COMMA':
+                    self.take()
+                elif self.peek().kind == 'RPAREN':
                     pass
                 else:
                     raise NotMatched('Expected , or )')
-            self.take(tokens)
-            return tokens, ASTNode('expr_atom_func_args', args)
+            self.take()
+            return ASTNode('expr_atom_func_args', args)
         else:
             raise NotMatched('Expected (')
 
-    def parse_expr_atom_index(self, tokens):
-        tokens = list(tokens)
-        args = []
-        if self.take(tokens).kind == 'LSQUARE':
-            tokens, tree = self.parse_expression(tokens)
-            args.append(tree)
-            if self.take(tokens).kind == 'RSQUARE':
-                return tokens, ASTNode('expr_atom_index', args)
+    @memoize
+    def parse_expr_atom_index(self):
+        if self.take().kind == 'LSQUARE':
+            args = [self.parse_expression()]
+            if self.take().kind == 'RSQUARE':
+                return ASTNode('expr_atom_index', args)
             else:
                 raise NotMatched('Expected ]')
         else:
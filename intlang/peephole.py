@@ -0,0 +1,197 @@
+from intlang.code_generator import FunctionBuilder, Immediate
+
+
+class Instruction:
+    def __init__(self, cells):
+        self.cells = list(cells)
+        # operand index -> (target instruction, cell offset within the target)
+        self.targets = {}
+        # instructions with a `$+N` operand pointing into this one
+        self.referrers = []
+        # set when the instruction is removed: where its jumps go instead
+        self.forward = None
+
+
+def relative_offset(value):
+    value = getattr(value, 'intcode', value)
+    if type(value) == str and value[0:2] == '$+':
+        return int(value[2:])
+    return None
+
+
+def with_offset(value, offset):
+    # Keep the wrapper type so the addressing mode of the instruction stays the same.
+    if hasattr(value, 'intcode'):
+        return type(value)(f'$+{offset}')
+    return f'$+{offset}'
+
+
+def is_immediate(value, intcode):
+    return type(value) == Immediate and value.intcode == intcode
+
+
+def is_add(ins, arg0, arg1, arg2):
+    # `None` matches any operand
+    if len(ins.cells) != 4 or ins.cells[0] % 100 != 1:
+        return False
+    for value, pattern in zip(ins.cells[1:], (arg0, arg1, arg2)):
+        if pattern is None:
+            continue
+        if type(pattern) == Immediate:
+            if not is_immediate(value, pattern.intcode):
+                return False
+        elif type(value) != type(pattern) or value != pattern:
+            return False
+    return True
+
+
+def is_push(window):
+    # add 0, sp, $+4; add 0, X, 0; add sp, -1, sp
+    return len(window) == 3 and \
+        is_add(window[0], Immediate(0), 'sp', '$+4') and \
+        is_add(window[1], Immediate(0), None, 0) and \
+        is_add(window[2], 'sp', Immediate(-1), 'sp')
+
+
+def is_pop(window):
+    # add sp, 1, $+3; add 0, 0, Y; add sp, 1, sp
+    return len(window) == 3 and \
+        is_add(window[0], 'sp', Immediate(1), '$+3') and \
+        is_add(window[1], Immediate(0), 0, None) and \
+        is_add(window[2], 'sp', Immediate(1), 'sp')
+
+
+def is_plain_operand(value):
+    # Registers, positions and immediates that do not depend on where the
+    # instruction ends up.
+    return relative_offset(value) is None and value not in ('sp', )
+
+
+def move(src, dst):
+    mode = FunctionBuilder.calculate_mode(Immediate(0), src, dst)
+    return Instruction([mode + 1, Immediate(0), src, dst])
+
+
+def rewrite(instructions, i):
+    """
+    Returns (number of instructions replaced, replacement) for a pattern
+    starting at i, or None.
+    """
+    window = instructions[i:i + 6]
+    if is_push(window[:3]) and is_pop(window[3:]):
+        # push X; pop Y -> Y = X
+        src, dst = window[1].cells[2], window[4].cells[3]
+        if is_plain_operand(src) and is_plain_operand(dst):
+            if type(src) == type(dst) and src == dst:
+                return 6, []
+            return 6, [move(src, dst)]
+    if is_pop(window[:3]) and is_push(window[3:]):
+        # pop Y; push Y -> read the top of the stack into Y
+        dst, src = window[1].cells[3], window[4].cells[2]
+        if is_plain_operand(dst) and type(src) == type(dst) and src == dst:
+            return 6, window[:2]
+    ins = instructions[i]
+    if len(ins.cells) == 4 and ins.cells[0] % 100 in (1, 2):
+        # add x, 0, x / add 0, x, x / mul x, 1, x / mul 1, x, x
+        identity = 0 if ins.cells[0] % 100 == 1 else 1
+        arg0, arg1, arg2 = ins.cells[1:]
+        if type(arg2) != Immediate and is_plain_operand(arg2):
+            for a, b in ((arg0, arg1), (arg1, arg0)):
+                if is_immediate(a, identity) and type(b) == type(arg2) and b == arg2:
+                    return 1, []
+    return None
+
+
+def replaceable(window):
+    # Anything outside the window may only jump to its first instruction;
+    # self-modifying writes into the window would be lost.
+    inside = set(map(id, window))
+    for n, ins in enumerate(window):
+        for src in ins.referrers:
+            if id(src) in inside:
+                continue
+            if n > 0:
+                return False
+            if any(target is ins and offset != 0
+                   for target, offset in src.targets.values()):
+                return False
+    return True
+
+
+def optimize(code):
+    """
+    Peephole-optimizes a function body given as a list of instructions
+    (lists of cells). Relative `$+N` operands are kept pointing at the same
+    instruction cell they pointed at before.
+    """
+    instructions = [Instruction(cells) for cells in code]
+    end = Instruction([])  # the cell right after the function
+
+    # Resolve `$+N` operands into (instruction, offset) pairs
+    owner = []
+    for ins in instructions:
+        owner.extend((ins, offset) for offset in range(len(ins.cells)))
+    loc = 0
+    for ins in instructions:
+        for k, value in enumerate(ins.cells[1:]):
+            offset = relative_offset(value)
+            if offset is not None:
+                target = loc + 1 + k + offset
+                if 0 <= target < len(owner):
+                    ins.targets[k] = owner[target]
+                elif target == len(owner):
+                    ins.targets[k] = (end, 0)
+                else:
+                    raise Exception(f"Relative operand out of function: {value}")
+                ins.targets[k][0].referrers.append(ins)
+        loc += len(ins.cells)
+
+    changed = True
+    while changed:
+        changed = False
+        i = 0
+        while i < len(instructions):
+            result = rewrite(instructions, i)
+            if result is not None:
+                length, replacement = result
+                window = instructions[i:i + length]
+                if replaceable(window):
+                    kept = set(map(id, replacement))
+                    for ins in window:
+                        if id(ins) in kept:
+                            continue
+                        for target, _ in ins.targets.values():
+                            target.referrers.remove(ins)
+                    following = replacement[0] if replacement else \
+                        (instructions[i + length] if i + length < len(instructions) else end)
+                    if window[0] is not following:
+                        window[0].forward = following
+                        following.referrers.extend(window[0].referrers)
+                    instructions[i:i + length] = replacement
+                    changed = True
+                    continue
+            i += 1
+
+    def resolve(ins):
+        while ins.forward is not None:
+            ins = ins.forward
+        return ins
+
+    # Lay the function out again and recompute the relative operands.
+    positions = {}
+    loc = 0
+    for ins in instructions:
+        positions[id(ins)] = loc
+        loc += len(ins.cells)
+    positions[id(end)] = loc
+
+    code = []
+    for ins in instructions:
+        for k, (target, offset) in ins.targets.items():
+            target = resolve(target)
+            relative = positions[id(target)] + offset - \
+                (positions[id(ins)] + 1 + k)
+            if relative != relative_offset(ins.cells[1 + k]):
+                ins.cells[1 + k] = with_offset(ins.cells[1 + k], relative)
+        code.append(ins.cells)
+    return code
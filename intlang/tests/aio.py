@@ -0,0 +1,97 @@
+# Checks of intlang.aio, run by `make test_aio`, which compares what this
+# prints with aio.out.
+import asyncio
+import socket
+
+from intlang import aio
+
+# Reads a value and outputs it plus one, `rounds` times.
+RELAY = '3,16,1001,16,1,16,4,16,1001,17,-1,17,1005,17,0,99,0,{rounds}'
+
+
+async def no_starvation():
+    # out 1; jt 1, 0: fills the output ring before a slice runs out, so the
+    # machine returns HAVE_OUTPUT every time and never PAUSED.
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0)
+
+    ticking = asyncio.ensure_future(ticker())
+    machine = aio.AsyncMachine('104,1,1105,1,0')
+    await asyncio.wait_for(asyncio.sleep(0.05), 1)
+    machine.task.cancel()
+    ticking.cancel()
+    print('busy machine lets others run:', ticks > 10)
+
+
+async def pipe():
+    # Two relays sharing a queue
+    first = aio.AsyncMachine(RELAY.format(rounds=3))
+    second = aio.AsyncMachine(RELAY.format(rounds=3), input=first.output)
+    for value in (1, 2, 3):
+        await first.input.put(value)
+    print('pipe:', [await second.output.get() for _ in range(3)])
+
+
+async def idle():
+    group = aio.Group()
+    first = group.start(RELAY.format(rounds=2))
+    second = group.start(RELAY.format(rounds=2), input=first.output)
+    await group.idle()
+    print('idle before any input:', first.waiting, second.waiting)
+    await first.input.put(10)
+    await group.idle()
+    print('idle after one value:', first.waiting, second.waiting, second.output.get_nowait())
+    await first.input.put(20)
+    await group.idle()
+    print('idle once halted:', first.done(), second.done(), second.output.get_nowait())
+
+    group = aio.Group()
+    group.start(RELAY.format(rounds=2))
+    group.start('1,0,0,100,99')
+    try:
+        await group.idle()
+    except Exception as e:
+        print('idle raises:', e)
+
+
+async def loopback():
+    machine = aio.AsyncMachine(RELAY.format(rounds=3))
+    reader, writer = await aio.loopback(machine)
+    writer.write(b'1\n2 3\n')
+    await writer.drain()
+    print('loopback:', (await reader.read()).split())
+    writer.close()
+
+
+async def malformed():
+    machine = aio.AsyncMachine(RELAY.format(rounds=3))
+    ours, theirs = socket.socketpair()
+    reader, writer = await asyncio.open_connection(sock=theirs)
+    serving = asyncio.ensure_future(aio.serve(machine, *await asyncio.open_connection(sock=ours)))
+    writer.write(b'1\nx\n')
+    await writer.drain()
+    try:
+        await serving
+    except Exception as e:
+        print('serve raises:', e)
+    await reader.read()
+    print('connection closed:', reader.at_eof())
+    machine.task.cancel()
+    writer.close()
+
+
+def main():
+    asyncio.run(no_starvation())
+    asyncio.run(pipe())
+    asyncio.run(idle())
+    asyncio.run(loopback())
+    asyncio.run(malformed())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# Checks of intlang.batch, run by `make test_batch`, which compares what
+# this prints with batch.out.
+from intlang import batch, vm
+from intlang.compiler import Compiler
+from intlang.parser import Parser
+
+# The slowest test programs take a minute in the batch VM.
+PROGRAMS = [1, 2, 4, 5, 7, 8, 9, 11]
+
+# in a; in b; out a / b; out a unless a < 0
+DIVIDE = '3,100,3,101,50,100,101,102,4,102,1007,100,0,103,1005,103,20,4,100,99,99' + ',0' * 90
+
+
+def run_lanes(image, inputs):
+    # The batch results next to one intlang.vm run per lane
+    lanes = batch.Batch(image, len(inputs))
+    mem0, outputs = lanes.run(inputs)
+    expected = [list(vm.run(image, row)) for row in inputs]
+    return lanes, outputs, outputs == expected
+
+
+def compiled():
+    for i in PROGRAMS:
+        with open(f'intlang/tests/{i}.il') as f:
+            ast = Parser().parse(f.read())
+        for target in ('classic', 'relative'):
+            image = Compiler(stack_size=2048, heap_size=4096, target=target).compile(ast)
+            _, _, same = run_lanes(image, [[]] * 3)
+            print(f'{i}.il {target}: same as intlang.vm: {same}')
+
+
+def divergent():
+    # The lanes take either branch of the jt.
+    lanes, outputs, same = run_lanes(DIVIDE, [[7, 2], [-7, 2]])
+    print('by ip:', outputs, same)
+    # IN writes the opcode at 2: add or mul 6 and 7 into mem[0].
+    lanes, outputs, same = run_lanes('3,2,0,6,7,0,4,0,99', [[1101], [1102]])
+    print('by opcode cell:', outputs, same)
+
+
+def division():
+    lanes, outputs, same = run_lanes(DIVIDE, [[7, 2], [-7, 2], [7, -2], [-7, -2]])
+    print('division:', [x[0] for x in outputs], same)
+
+
+def panics():
+    # The second lane divides by zero, the third reads out of memory.
+    lanes = batch.Batch(DIVIDE, 3)
+    lanes.mem[2, 7] = 1000
+    mem0, outputs = lanes.run([[7, 2], [5, 0], [7, 2]])
+    print('panics:', outputs, lanes.status.tolist(), sorted(lanes.errors.items()),
+          lanes.ip.tolist())
+
+
+def resume():
+    # out(in); out(in), needing input on each IN
+    lanes = batch.Batch('3,0,4,0,3,0,4,0,99', 2)
+    print('resume:', lanes.run([]), lanes.status.tolist())
+    print('resume:', lanes.run([7]), lanes.status.tolist())
+    print('resume:', lanes.run([[8], [9]]), lanes.status.tolist())
+
+
+def main():
+    compiled()
+    divergent()
+    division()
+    panics()
+    resume()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+# Checks that the parser gives the same tree with and without packrat
+# memoization, run by `make test_packrat`, which compares what this prints
+# with packrat.out.
+import glob
+
+from intlang.parser import Parser
+
+
+def main():
+    paths = sorted(glob.glob('intlang/tests/*.il'), key=lambda x: int(x.split('/')[-1][:-3]))
+    for path in paths + ['day3.il']:
+        with open(path) as f:
+            source = f.read()
+        same = Parser().parse(source) == Parser(packrat=True).parse(source)
+        print(f'{path}: same tree: {same}')
+
+
+if __name__ == '__main__':
+    main()
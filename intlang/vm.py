@@ -0,0 +1,153 @@
+# In-process binding to the C VM (vm/intcode_vm.c), built as a shared
+# library with `make libintcode`.
+from array import array
+import ctypes
+import os
+
+from intlang.code_generator import IMAGE_MAGIC
+
+LIBRARY = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'vm', 'libintcode.so')
+
+# Values of intcode_status
+HALTED, NEED_INPUT, HAVE_OUTPUT, PANICKED, PAUSED = range(5)
+
+RING_SIZE = 4096
+
+
+class Ring(ctypes.Structure):
+    _fields_ = [('cells', ctypes.c_void_p), ('capacity', ctypes.c_size_t),
+                ('start', ctypes.c_size_t), ('size', ctypes.c_size_t)]
+
+
+_library = None
+
+
+def library():
+    global _library
+    if _library is None:
+        path = os.getenv('INTCODE_LIB', LIBRARY)
+        if not os.path.exists(path):
+            raise Exception(f"{path} does not exist, build it with `make libintcode`")
+        lib = ctypes.CDLL(path)
+        vm_p = ctypes.c_void_p
+        lib.intcode_vm_new_from_text.argtypes = [ctypes.c_char_p, ctypes.c_size_t]
+        lib.intcode_vm_new_from_image.argtypes = [ctypes.c_char_p, ctypes.c_size_t]
+        lib.intcode_vm_new_from_cells.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        for f in (lib.intcode_vm_new_from_text, lib.intcode_vm_new_from_image,
+                  lib.intcode_vm_new_from_cells):
+            f.restype = vm_p
+        lib.intcode_vm_destroy.argtypes = [ctypes.POINTER(vm_p)]
+        lib.intcode_vm_destroy.restype = None
+        lib.intcode_vm_attach.argtypes = [
+            vm_p, ctypes.POINTER(Ring), ctypes.POINTER(Ring)]
+        lib.intcode_vm_attach.restype = None
+        lib.intcode_vm_run.argtypes = [vm_p]
+        lib.intcode_vm_run.restype = ctypes.c_int
+        lib.intcode_vm_run_slice.argtypes = [vm_p, ctypes.c_ulonglong]
+        lib.intcode_vm_run_slice.restype = ctypes.c_int
+        lib.intcode_vm_get_error.argtypes = [vm_p]
+        lib.intcode_vm_get_error.restype = ctypes.c_char_p
+        lib.intcode_vm_get_n_executed.argtypes = [vm_p]
+        lib.intcode_vm_get_n_executed.restype = ctypes.c_ulonglong
+        _library = lib
+    return _library
+
+
+def cells(values):
+    # An int64 array, without a copy if it already is one.
+    if isinstance(values, array) and values.typecode == 'q':
+        return values
+    return array('q', values)
+
+
+class Machine:
+    """
+    A VM with its own input and output rings. run() executes until the
+    program halts, needs input that was not fed yet, or has filled the
+    output ring, and can be called again to continue.
+    """
+
+    def __init__(self, image, ring_size=RING_SIZE):
+        lib = self.lib = library()
+        if isinstance(image, (bytes, bytearray)) and image[:len(IMAGE_MAGIC)] == IMAGE_MAGIC:
+            self.vm = lib.intcode_vm_new_from_image(bytes(image), len(image))
+        elif isinstance(image, str):
+            source = image.encode()
+            self.vm = lib.intcode_vm_new_from_text(source, len(source))
+        else:
+            image = cells(image)
+            self.vm = lib.intcode_vm_new_from_cells(image.buffer_info()[0], len(image))
+        if not self.vm:
+            raise Exception("Invalid program image")
+
+        self.input_cells = array('q', bytes(8 * ring_size))
+        self.output_cells = array('q', bytes(8 * ring_size))
+        self.input = Ring(self.input_cells.buffer_info()[0], ring_size, 0, 0)
+        self.output = Ring(self.output_cells.buffer_info()[0], ring_size, 0, 0)
+        lib.intcode_vm_attach(self.vm, self.input, self.output)
+
+    def __del__(self):
+        if getattr(self, 'vm', None):
+            self.lib.intcode_vm_destroy(ctypes.byref(ctypes.c_void_p(self.vm)))
+            self.vm = None
+
+    def run(self, instructions=None):
+        # Given a number of instructions, returns PAUSED at the first jump
+        # after them.
+        if instructions is None:
+            status = self.lib.intcode_vm_run(self.vm)
+        else:
+            status = self.lib.intcode_vm_run_slice(self.vm, instructions)
+        if status == PANICKED:
+            raise Exception(f"VM panic: {self.lib.intcode_vm_get_error(self.vm).decode()}")
+        return status
+
+    @property
+    def n_executed(self):
+        # Instructions executed so far
+        return self.lib.intcode_vm_get_n_executed(self.vm)
+
+    def feed(self, values):
+        # Queues as many values as fit in the input ring and returns how many.
+        values = cells(values)
+        ring, ring_cells = self.input, self.input_cells
+        n = min(len(values), ring.capacity - ring.size)
+        end = (ring.start + ring.size) % ring.capacity
+        first = min(n, ring.capacity - end)
+        ring_cells[end:end + first] = values[:first]
+        ring_cells[:n - first] = values[first:n]
+        ring.size += n
+        return n
+
+    def read(self):
+        # Takes everything in the output ring.
+        ring, ring_cells = self.output, self.output_cells
+        first = min(ring.size, ring.capacity - ring.start)
+        values = ring_cells[ring.start:ring.start + first] + ring_cells[:ring.size - first]
+        ring.start = (ring.start + ring.size) % ring.capacity
+        ring.size = 0
+        return values
+
+
+def run(image, inputs=()):
+    """
+    Runs a program in this process and returns what it printed, as an
+    array('q'). `image` can be any output of Compiler.compile (the text
+    format or a binary image) or the cells themselves, such as
+    CodeGenerator.link() returns. IN reads `inputs` in order; a panic,
+    including running out of inputs, raises an exception.
+    """
+    machine = Machine(image)
+    inputs = cells(inputs)
+    n_fed = 0
+    outputs = array('q')
+    while True:
+        status = machine.run()
+        outputs.extend(machine.read())
+        if status == HALTED:
+            return outputs
+        if status == NEED_INPUT:
+            if n_fed == len(inputs):
+                raise Exception("The program needs more input than was given")
+            n_fed += machine.feed(inputs[n_fed:])
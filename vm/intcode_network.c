@@ -0,0 +1,250 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include "intcode_network.h"
+
+intcode_network* intcode_network_new(void) {
+  intcode_network* net = (intcode_network *)malloc(sizeof(intcode_network));
+  net->nodes    = NULL;
+  net->n_nodes  = 0;
+  net->capacity = 0;
+  net->n_rounds = 0;
+  net->error    = NULL;
+  net->failed   = -1;
+  return net;
+}
+
+void intcode_network_destroy(intcode_network** net) {
+  for (unsigned int i = 0; i < (*net)->n_nodes; i++) {
+    intcode_node* node = &(*net)->nodes[i];
+    free(node->name);
+    free(node->targets);
+    free(node->input.cells);
+    free(node->output.cells);
+    intcode_vm_destroy(&node->vm);
+  }
+  free((*net)->nodes);
+  free((void *)*net);
+  *net = (intcode_network *)NULL;
+}
+
+// Adds a node running `vm`, which the network now owns. Returns its index.
+int intcode_network_add(intcode_network* net, const char* name, intcode_vm* vm) {
+  if (net->n_nodes == net->capacity) {
+    net->capacity = net->capacity ? net->capacity * 2 : 16;
+    net->nodes = (intcode_node *)realloc(net->nodes, net->capacity * sizeof(intcode_node));
+  }
+  intcode_node* node = &net->nodes[net->n_nodes];
+  node->name = strdup(name);
+  node->vm = vm;
+  intcode_ring_init(&node->input, (intcode_int *)malloc(INTCODE_CHANNEL_SIZE * sizeof(intcode_int)),
+                    INTCODE_CHANNEL_SIZE);
+  intcode_ring_init(&node->output, (intcode_int *)malloc(INTCODE_CHANNEL_SIZE * sizeof(intcode_int)),
+                    INTCODE_CHANNEL_SIZE);
+  node->targets = NULL;
+  node->n_targets = 0;
+  node->n_sources = 0;
+  node->print = 0;
+  node->halted = 0;
+  return net->n_nodes++;
+}
+
+// Returns the index of the node called `name`, or -1.
+int intcode_network_find(intcode_network* net, const char* name) {
+  for (unsigned int i = 0; i < net->n_nodes; i++) {
+    if (strcmp(net->nodes[i].name, name) == 0) return i;
+  }
+  return -1;
+}
+
+// Feeds what `from` outputs to `to`. A node with several targets sends each
+// of them every value; a node with several sources reads their values in
+// the order they were output.
+void intcode_network_connect(intcode_network* net, int from, int to) {
+  intcode_node* node = &net->nodes[from];
+  node->targets = (int *)realloc(node->targets, (node->n_targets + 1) * sizeof(int));
+  node->targets[node->n_targets++] = to;
+  net->nodes[to].n_sources++;
+}
+
+// Queues an input for a node, before running the network. Returns 0 if its
+// input ring is full.
+int intcode_network_feed(intcode_network* net, int node, intcode_int value) {
+  return intcode_ring_push(&net->nodes[node].input, value);
+}
+
+// Moves what a node output to its targets, as far as they have room, and
+// prints it if asked to. Targets that halted drop the values. Returns 1 if
+// anything was moved.
+static int intcode_network_deliver(intcode_network* net, intcode_node* node) {
+  int moved = 0;
+  intcode_int value;
+  while (node->output.size > 0) {
+    for (unsigned int k = 0; k < node->n_targets; k++) {
+      intcode_node* target = &net->nodes[node->targets[k]];
+      if (!target->halted && target->input.size == target->input.capacity) return moved;
+    }
+    intcode_ring_pop(&node->output, &value);
+    if (node->print) printf("%lld\n", value);
+    for (unsigned int k = 0; k < node->n_targets; k++) {
+      intcode_node* target = &net->nodes[node->targets[k]];
+      if (!target->halted) intcode_ring_push(&target->input, value);
+    }
+    moved = 1;
+  }
+  return moved;
+}
+
+// Runs the nodes round-robin, each until it halts or blocks on its rings,
+// until all of them halted. Returns 0 then, or -1 if a node panicked or no
+// node can go on (see net->error).
+int intcode_network_run(intcode_network* net) {
+  net->error = NULL;
+  net->failed = -1;
+
+  // A node that is the only source of its only target writes into the input
+  // ring of the target; the others need their values copied.
+  for (unsigned int i = 0; i < net->n_nodes; i++) {
+    intcode_node* node = &net->nodes[i];
+    intcode_ring* output = &node->output;
+    if (node->n_targets == 1 && net->nodes[node->targets[0]].n_sources == 1 &&
+        !node->print && node->output.size == 0) {
+      output = &net->nodes[node->targets[0]].input;
+    }
+    intcode_vm_attach(node->vm, &node->input, output);
+  }
+
+  for (;;) {
+    int running = 0, progress = 0;
+    for (unsigned int i = 0; i < net->n_nodes; i++) {
+      intcode_node* node = &net->nodes[i];
+      if (node->halted) {
+        if (node->input.size > 0) {
+          node->input.size = 0;
+          progress = 1;
+        }
+        if (node->output.size > 0) {
+          progress |= intcode_network_deliver(net, node);
+          running++;
+        }
+        continue;
+      }
+      running++;
+
+      intcode_vm* vm = node->vm;
+      progress |= intcode_network_deliver(net, node);
+      unsigned long long executed = vm->n_executed;
+      intcode_status status = intcode_vm_run(vm);
+      if (status == INTCODE_PANICKED) {
+        net->error = intcode_vm_get_error(vm);
+        net->failed = i;
+        return -1;
+      }
+      if (status == INTCODE_HALTED) {
+        node->halted = 1;
+        progress = 1;
+      } else if (vm->n_executed != executed) {
+        progress = 1;
+      }
+      progress |= intcode_network_deliver(net, node);
+    }
+    net->n_rounds++;
+    if (running == 0) return 0;
+    if (!progress) {
+      net->error = "deadlock, every node is waiting";
+      return -1;
+    }
+  }
+}
+
+static int intcode_network_error(const char* path, int line, const char* message) {
+  fprintf(stderr, "%s:%d: %s\n", path, line, message);
+  return -1;
+}
+
+// Parses a line of a topology spec into the network. Returns -1 on error.
+static int intcode_network_parse(intcode_network* net, const char* path, int line, char* text) {
+  char* comment = strchr(text, '#');
+  if (comment != NULL) *comment = '\0';
+  const char* delim = " \t\r\n";
+  char* word = strtok(text, delim);
+  if (word == NULL) return 0;
+
+  if (strcmp(word, "node") == 0) {
+    char* name = strtok(NULL, delim);
+    char* program = strtok(NULL, delim);
+    if (name == NULL || program == NULL || strtok(NULL, delim) != NULL) {
+      return intcode_network_error(path, line, "expected `node NAME PROGRAM`");
+    }
+    if (intcode_network_find(net, name) >= 0) {
+      return intcode_network_error(path, line, "node defined twice");
+    }
+    intcode_vm* vm = intcode_vm_load(program);
+    if (vm == NULL) return intcode_network_error(path, line, "cannot load program");
+    intcode_network_add(net, name, vm);
+    return 0;
+  }
+
+  if (strcmp(word, "input") == 0 || strcmp(word, "print") == 0) {
+    int is_input = word[0] == 'i';
+    char* name = strtok(NULL, delim);
+    int node = name ? intcode_network_find(net, name) : -1;
+    if (node < 0) return intcode_network_error(path, line, "unknown node");
+    if (!is_input) {
+      net->nodes[node].print = 1;
+      return strtok(NULL, delim) ? intcode_network_error(path, line, "expected `print NAME`") : 0;
+    }
+    while ((word = strtok(NULL, delim)) != NULL) {
+      char* end;
+      intcode_int value = strtoll(word, &end, 10);
+      if (*end != '\0') return intcode_network_error(path, line, "malformed input value");
+      if (!intcode_network_feed(net, node, value)) {
+        return intcode_network_error(path, line, "too many input values");
+      }
+    }
+    return 0;
+  }
+
+  // A -> B -> C ...
+  int from = intcode_network_find(net, word);
+  if (from < 0) return intcode_network_error(path, line, "unknown node");
+  char* arrow = strtok(NULL, delim);
+  if (arrow == NULL) return intcode_network_error(path, line, "expected `NAME -> NAME`");
+  for (; arrow != NULL; arrow = strtok(NULL, delim)) {
+    if (strcmp(arrow, "->") != 0) return intcode_network_error(path, line, "expected `->`");
+    char* name = strtok(NULL, delim);
+    int to = name ? intcode_network_find(net, name) : -1;
+    if (to < 0) return intcode_network_error(path, line, "unknown node");
+    intcode_network_connect(net, from, to);
+    from = to;
+  }
+  return 0;
+}
+
+// Loads a network from a topology spec, a text file of lines like:
+//
+//   node NAME PROGRAM     # a VM running PROGRAM (a path, see intcode_vm_load)
+//   A -> B -> C           # what A outputs is input to B, and B's to C
+//   input NAME 1 2 3      # values queued for the input of NAME
+//   print NAME            # print what NAME outputs
+//
+// Nodes are declared before use. Reports errors on stderr and returns NULL.
+intcode_network* intcode_network_load(const char* path) {
+  FILE* file = fopen(path, "r");
+  if (file == NULL) {
+    fprintf(stderr, "%s: cannot open\n", path);
+    return NULL;
+  }
+  intcode_network* net = intcode_network_new();
+  char text[4096];
+  int line = 0;
+  while (fgets(text, sizeof(text), file) != NULL) {
+    line++;
+    if (intcode_network_parse(net, path, line, text) != 0) {
+      intcode_network_destroy(&net);
+      break;
+    }
+  }
+  fclose(file);
+  return net;
+}
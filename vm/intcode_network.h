@@ -0,0 +1,44 @@
+#ifndef __INTCODE_NETWORK
+#define __INTCODE_NETWORK
+
+#include "intcode_vm.h"
+
+// Cells in each ring of a network
+#define INTCODE_CHANNEL_SIZE 1024
+
+// A VM of a network. Its input ring takes what its sources output; its
+// output ring is used when the values have to be copied to the targets,
+// otherwise the VM writes straight into the input ring of its only target.
+typedef struct {
+  char*        name;
+  intcode_vm*  vm;
+  intcode_ring input;
+  intcode_ring output;
+  int*         targets;       // indices of the nodes fed by this one
+  unsigned int n_targets;
+  unsigned int n_sources;
+  int          print;         // also print what the node outputs
+  int          halted;
+} intcode_node;
+
+// VMs whose outputs feed each other's inputs, run in one process
+typedef struct {
+  intcode_node* nodes;
+  unsigned int  n_nodes;
+  unsigned int  capacity;
+  unsigned long long n_rounds;  // round-robin passes over the nodes so far
+  const char*   error;          // why the last run failed, or NULL
+  int           failed;         // the node that panicked, or -1
+} intcode_network;
+
+intcode_network* intcode_network_new(void);
+intcode_network* intcode_network_load(const char*);
+void intcode_network_destroy(intcode_network**);
+
+int  intcode_network_add(intcode_network*, const char*, intcode_vm*);
+int  intcode_network_find(intcode_network*, const char*);
+void intcode_network_connect(intcode_network*, int, int);
+int  intcode_network_feed(intcode_network*, int, intcode_int);
+int  intcode_network_run(intcode_network*);
+
+#endif
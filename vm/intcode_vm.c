@@ -1,35 +1,204 @@
+#include <fcntl.h>
+#include <limits.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
 #include "intcode_vm.h"
 
-intcode_vm* intcode_vm_new(const char *source) {
+static intcode_vm* intcode_vm_alloc(intcode_int* mem, unsigned int mem_size) {
   intcode_vm* vm = (intcode_vm *)malloc(sizeof(intcode_vm));
-  unsigned int size = 1;
+  vm->mem          = mem;
+  vm->mem_size     = mem_size;
+  vm->ip           = 0;
+  vm->mapping      = NULL;
+  vm->mapping_size = 0;
+  vm->n_executed   = 0;
+  vm->n_dispatched = 0;
+  vm->slice_end    = ULLONG_MAX;
+  vm->relative_base = 0;
+  vm->decoded      = NULL;
+  vm->decoded_end  = 0;
+  vm->profile      = NULL;
+  vm->input        = NULL;
+  vm->output       = NULL;
+  vm->error        = NULL;
+  vm->on_panic     = NULL;
+  return vm;
+}
+
+static int intcode_is_space(char c) {
+  return c == ' ' || c == '\t' || c == '\r' || c == '\n';
+}
+
+// Parse a comma-separated program in a single pass. The source does not need
+// to be NUL-terminated, so this also works on a mapped file. A trailing comma
+// is allowed; anything else that is not a cell makes it return NULL.
+intcode_vm* intcode_vm_new_from_text(const char *src, size_t len) {
+  const char *end = src + len;
+  size_t capacity = 1024;
+  size_t size = 0;
+  intcode_int* mem = (intcode_int*)malloc(capacity * sizeof(intcode_int));
+
+  while (src < end && intcode_is_space(*src)) src++;
+  while (src < end) {
+    int negative = 0;
+    if (*src == '-' || *src == '+') {
+      negative = *src == '-';
+      src++;
+    }
+    if (src == end || *src < '0' || *src > '9') goto malformed;
+
+    unsigned long long value = 0;
+    while (src < end && *src >= '0' && *src <= '9') {
+      value = value * 10 + (unsigned long long)(*src - '0');
+      src++;
+    }
 
-  // Calculate the size of memory needed.
-  for(const char *src = source; *src != '\0'; src++) {
-    if (*src == ',') size++;
+    if (size == capacity) {
+      capacity *= 2;
+      mem = (intcode_int*)realloc(mem, capacity * sizeof(intcode_int));
+    }
+    mem[size++] = negative ? -(intcode_int)value : (intcode_int)value;
+
+    while (src < end && intcode_is_space(*src)) src++;
+    if (src == end) break;
+    if (*src != ',') goto malformed;
+    src++;
+    while (src < end && intcode_is_space(*src)) src++;
   }
 
-  vm->mem      = (intcode_int*)malloc(size * sizeof(intcode_int));
-  vm->mem_size = size;
-  vm->ip       = 0;
+  return intcode_vm_alloc(mem, size);
 
-  // Fill out the allocated memory with the given source.
-  intcode_int* mem = vm->mem;
-  for(const char *src = source; *src != '\0'; src++) {
-    if (*(src - 1) == ',' || src == source) {
-      sscanf(src, "%lld", mem);
-      mem = &mem[1];
+malformed:
+  free(mem);
+  return NULL;
+}
+
+intcode_vm* intcode_vm_new(const char *source) {
+  return intcode_vm_new_from_text(source, strlen(source));
+}
+
+int intcode_is_image(const void *buf, size_t size) {
+  return size >= sizeof(intcode_image_header) &&
+    memcmp(buf, INTCODE_IMAGE_MAGIC, sizeof(INTCODE_IMAGE_MAGIC)) == 0;
+}
+
+static intcode_int intcode_read_le64(const unsigned char *src) {
+  unsigned long long value = 0;
+  for (int i = 7; i >= 0; i--) {
+    value = (value << 8) | src[i];
+  }
+  return (intcode_int)value;
+}
+
+intcode_vm* intcode_vm_new_from_image(const void *buf, size_t size) {
+  if (!intcode_is_image(buf, size)) return NULL;
+
+  const unsigned char *src = (const unsigned char *)buf;
+  intcode_int n_cells = intcode_read_le64(src + offsetof(intcode_image_header, n_cells));
+  if (n_cells < 0 || n_cells > UINT_MAX ||
+      (size - sizeof(intcode_image_header)) / sizeof(intcode_int) < (size_t)n_cells) {
+    return NULL;
+  }
+
+  intcode_vm* vm = intcode_vm_alloc(
+    (intcode_int*)malloc(n_cells * sizeof(intcode_int)), n_cells);
+
+  src += sizeof(intcode_image_header);
+  for (intcode_int i = 0; i < n_cells; i++, src += sizeof(intcode_int)) {
+    vm->mem[i] = intcode_read_le64(src);
+  }
+
+  return vm;
+}
+
+intcode_vm* intcode_vm_new_from_cells(const intcode_int *cells, size_t n_cells) {
+  if (n_cells > UINT_MAX) return NULL;
+  intcode_int* mem = (intcode_int*)malloc(n_cells * sizeof(intcode_int));
+  memcpy(mem, cells, n_cells * sizeof(intcode_int));
+  return intcode_vm_alloc(mem, n_cells);
+}
+
+// Read a file that cannot be mapped, such as a pipe.
+static char *intcode_read_stream(int fd, size_t *size) {
+  size_t capacity = 1024 * 1024;
+  char *buf = (char *)malloc(capacity);
+  ssize_t n;
+  *size = 0;
+  while ((n = read(fd, buf + *size, capacity - *size)) > 0) {
+    *size += n;
+    if (*size == capacity) {
+      capacity *= 2;
+      buf = (char *)realloc(buf, capacity);
     }
   }
+  return buf;
+}
 
+static intcode_vm* intcode_vm_new_from_buffer(const char *buf, size_t size) {
+  if (intcode_is_image(buf, size)) {
+    return intcode_vm_new_from_image(buf, size);
+  }
+  return intcode_vm_new_from_text(buf, size);
+}
+
+intcode_vm* intcode_vm_load(const char *path) {
+  int fd = open(path, O_RDONLY);
+  if (fd < 0) return NULL;
+
+  struct stat st;
+  if (fstat(fd, &st) < 0 || !S_ISREG(st.st_mode) || st.st_size == 0) {
+    size_t size;
+    char *buf = intcode_read_stream(fd, &size);
+    close(fd);
+    intcode_vm* vm = intcode_vm_new_from_buffer(buf, size);
+    free(buf);
+    return vm;
+  }
+
+  size_t size = st.st_size;
+  // Private, writable mapping: pages are copied only when the VM writes to them.
+  char *base = (char *)mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_PRIVATE, fd, 0);
+  close(fd);
+  if (base == MAP_FAILED) return NULL;
+
+  intcode_vm* vm;
+#if __BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__
+  if (intcode_is_image(base, size)) {
+    // The cells are already in the VM's layout; use the mapping as memory.
+    const intcode_image_header *header = (const intcode_image_header *)base;
+    if (header->n_cells < 0 || header->n_cells > UINT_MAX ||
+        (size - sizeof(intcode_image_header)) / sizeof(intcode_int) < (size_t)header->n_cells) {
+      munmap(base, size);
+      return NULL;
+    }
+    vm = intcode_vm_alloc((intcode_int*)(base + sizeof(intcode_image_header)), header->n_cells);
+    vm->mapping      = base;
+    vm->mapping_size = size;
+    return vm;
+  }
+#endif
+  vm = intcode_vm_new_from_buffer(base, size);
+  munmap(base, size);
   return vm;
 }
 
 void intcode_vm_destroy(intcode_vm** vm) {
-  free((*vm)->mem);
+  free((*vm)->decoded);
+  if ((*vm)->profile != NULL) {
+    free((*vm)->profile->executed);
+    free((*vm)->profile->code_writes);
+    free((*vm)->profile->code);
+    free((*vm)->profile);
+  }
+  if ((*vm)->mapping != NULL) {
+    munmap((*vm)->mapping, (*vm)->mapping_size);
+  } else {
+    free((*vm)->mem);
+  }
   free((void *)*vm);
   *vm = (intcode_vm *)NULL;
 }
@@ -44,6 +213,16 @@ const char *intcode_vm_get_opcode_str(intcode_int opcode) {
     return "IN";
   case OP_OUT:
     return "OUT";
+  case OP_JT:
+    return "JT";
+  case OP_JF:
+    return "JF";
+  case OP_LT:
+    return "LT";
+  case OP_EQ:
+    return "EQ";
+  case OP_ARB:
+    return "ARB";
   case OP_HALT:
     return "HALT";
   // Added, not in the original spec
@@ -66,6 +245,16 @@ unsigned int intcode_vm_get_opcode_n_operands(intcode_int opcode) {
     return 1;
   case OP_OUT:
     return 1;
+  case OP_JT:
+    return 2;
+  case OP_JF:
+    return 2;
+  case OP_LT:
+    return 3;
+  case OP_EQ:
+    return 3;
+  case OP_ARB:
+    return 1;
   case OP_HALT:
     return 0;
   // Added, not in the original spec
@@ -89,28 +278,55 @@ unsigned int intcode_vm_decode_and_print(intcode_vm* vm, intcode_int addr) {
 }
 
 intcode_int intcode_vm_panic(intcode_vm* vm, const char* reason) {
+  if (vm->on_panic != NULL) {
+    vm->error = reason;
+    longjmp(*vm->on_panic, 1);
+  }
   intcode_vm_decode_and_print(vm, vm->ip);
   printf("Panic: %s\n", reason);
   exit(1);
 }
 
-intcode_int intcode_vm_run(intcode_vm* vm) {
+void intcode_vm_attach(intcode_vm* vm, intcode_ring* input, intcode_ring* output) {
+  vm->input = input;
+  vm->output = output;
+}
+
+const char* intcode_vm_get_error(intcode_vm* vm) {
+  return vm->error;
+}
+
+unsigned long long intcode_vm_get_n_executed(intcode_vm* vm) {
+  return vm->n_executed;
+}
+
+// The straightforward fetch-decode-execute loop. It decodes every
+// instruction from scratch, and is kept as the reference that the cached
+// loop below is benchmarked and tested against. It reads stdin and prints
+// to stdout, and runs until HALT.
+intcode_int intcode_vm_run_uncached(intcode_vm* vm) {
 #define FETCH_OPCODE() (vm->mem[vm->ip] % 100)
 #define FETCH_MODE() (vm->mem[vm->ip] / 100)
 #define FETCH_OPERAND_UNSAFE(offset) (vm->mem[vm->ip + offset])
-#define FETCH_OPERAND(offset) (vm->mem_size <= (unsigned int)vm->mem[vm->ip + offset] ? intcode_vm_panic(vm, "bad position") : vm->mem[vm->ip + offset])
-#define OPERAND_REF(offset) (vm->mem[FETCH_OPERAND(offset)])
-#define OPERAND_VALUE(offset) ((mode & (1 << (offset - 1))) == 0 ? vm->mem[FETCH_OPERAND(offset)] : FETCH_OPERAND_UNSAFE(offset))
+#define CHECK_POSITION(position) (vm->mem_size <= (unsigned int)(position) ? intcode_vm_panic(vm, "bad position") : (position))
+#define OPERAND_POSITION(offset) (mode[offset] == MODE_RELATIVE ? CHECK_POSITION(vm->relative_base + FETCH_OPERAND_UNSAFE(offset)) : CHECK_POSITION(FETCH_OPERAND_UNSAFE(offset)))
+#define OPERAND_REF(offset) (vm->mem[OPERAND_POSITION(offset)])
+#define OPERAND_VALUE(offset) (mode[offset] == MODE_IMMEDIATE ? FETCH_OPERAND_UNSAFE(offset) : OPERAND_REF(offset))
 #define ADVANCE_IP() (vm->ip += 1 + intcode_vm_get_opcode_n_operands(opcode))
   unsigned char running = 1;
 
   // Fetch-decode-execute loop
   while(running && vm->ip < vm->mem_size) {
     intcode_int opcode = FETCH_OPCODE();
-    unsigned char mode = \
-      ((FETCH_MODE() / 100) << 2) + \
-      ((FETCH_MODE() % 100 / 10) << 1) + \
-      (FETCH_MODE() % 10);
+    vm->n_executed++;
+    vm->n_dispatched++;
+    // mode[n] is the mode of the n-th operand
+    unsigned char mode[4] = {
+      0,
+      FETCH_MODE() % 10,
+      FETCH_MODE() / 10 % 10,
+      FETCH_MODE() / 100 % 10
+    };
 
     #ifdef DEBUG
     intcode_vm_decode_and_print(vm, vm->ip);
@@ -133,9 +349,34 @@ intcode_int intcode_vm_run(intcode_vm* vm) {
       printf("%lld\n", OPERAND_VALUE(1));
       ADVANCE_IP();
       break;
+    case OP_JT:
+      if(OPERAND_VALUE(1) != 0){
+        vm->ip = OPERAND_VALUE(2);
+      } else {
+        ADVANCE_IP();
+      }
+      break;
+    case OP_JF:
+      if(OPERAND_VALUE(1) == 0){
+        vm->ip = OPERAND_VALUE(2);
+      } else {
+        ADVANCE_IP();
+      }
+      break;
+    case OP_LT:
+      OPERAND_REF(3) = OPERAND_VALUE(1) < OPERAND_VALUE(2);
+      ADVANCE_IP();
+      break;
+    case OP_EQ:
+      OPERAND_REF(3) = OPERAND_VALUE(1) == OPERAND_VALUE(2);
+      ADVANCE_IP();
+      break;
+    case OP_ARB:
+      vm->relative_base += OPERAND_VALUE(1);
+      ADVANCE_IP();
+      break;
     case OP_HALT:
       running = 0;
-      ADVANCE_IP();
       return vm->mem[0]; // Return the first value of the memory when halting.
 
     // Added, not in the original spec
@@ -159,4 +400,486 @@ intcode_int intcode_vm_run(intcode_vm* vm) {
   }
 
   return vm->mem[0];
+#undef FETCH_OPCODE
+#undef FETCH_MODE
+#undef FETCH_OPERAND_UNSAFE
+#undef CHECK_POSITION
+#undef OPERAND_POSITION
+#undef OPERAND_REF
+#undef OPERAND_VALUE
+#undef ADVANCE_IP
+}
+
+// Handlers of decoded instructions; 0 means the cell is not decoded yet.
+enum {
+  DECODED_NONE = 0,
+  DECODED_ADD, DECODED_MUL, DECODED_IN, DECODED_OUT, DECODED_JT, DECODED_JF,
+  DECODED_LT, DECODED_EQ, DECODED_ARB, DECODED_HALT, DECODED_DIV, DECODED_JGE,
+  DECODED_INVALID, DECODED_TRUNCATED,
+  // Superinstructions for the sequences FunctionBuilder emits, see
+  // intcode_vm_fuse. They must come last.
+  DECODED_STORE, DECODED_PUSH, DECODED_CALL,
+  DECODED_LOAD, DECODED_POP, DECODED_RET,
+  N_DECODED
+};
+
+#define MAX_FUSED_LENGTH 16
+
+// Recognizes the idioms of intlang/code_generator.py starting at addr, all
+// built around an ADD that patches an operand of the ADD right after it:
+//   STORE  add A, B, $+4; add 0, X, <patched>           (write_stack)
+//   PUSH   STORE; add S, -1, S                          (push)
+//   CALL   PUSH; jge 0, 0, F                            (call)
+//   LOAD   add A, B, $+3; add 0, <patched>, Y           (read_stack)
+//   POP    LOAD; add S, 1, S                            (pop)
+//   RET    LOAD into the jge operand; jge 0, 0, <patched>   (ret)
+// mode[] holds the modes of A, B and X/Y; every other operand is read from
+// memory when executed, like for any other instruction. The cells checked
+// here are marked as covered, and writing to one of them drops the
+// superinstruction, so it always executes as the instructions it replaces.
+static void intcode_vm_fuse(intcode_vm* vm, unsigned int addr) {
+  intcode_decoded* d = &vm->decoded[addr];
+  const intcode_int* mem = vm->mem + addr;
+  unsigned int available = vm->mem_size - addr;
+  // Offsets of the cells the match depends on, besides the first one
+  unsigned int covered[4] = { 3, 4 };
+  unsigned int n_covered = 2;
+
+  if (d->op != DECODED_ADD || mem[0] / 10000 != 0 || available < 8) {
+    return;
+  }
+  if (mem[3] == addr + 7 && mem[4] % 1000 == 101 && mem[4] / 10000 == 0) {
+    d->op = DECODED_STORE;
+    d->length = 8;
+    d->mode[2] = mem[4] / 1000 % 10;
+    if (available >= 12 && mem[8] == 1001) {
+      d->op = DECODED_PUSH;
+      d->length = 12;
+      covered[n_covered++] = 8;
+      if (available >= 16 && mem[12] == 1160) {
+        d->op = DECODED_CALL;
+        d->length = 16;
+        covered[n_covered++] = 12;
+      }
+    }
+  } else if (mem[3] == addr + 6 && mem[4] % 10000 == 101 && mem[4] / 10000 < 10) {
+    d->op = DECODED_LOAD;
+    d->length = 8;
+    d->mode[2] = mem[4] / 10000;
+    if (available >= 12 && mem[8] == 1001) {
+      d->op = DECODED_POP;
+      d->length = 12;
+      covered[n_covered++] = 8;
+    } else if (available >= 12 && mem[8] == 11160 && mem[7] == addr + 11
+               && d->mode[2] == MODE_POSITION) {
+      d->op = DECODED_RET;
+      d->length = 12;
+      covered[n_covered++] = 7;
+      covered[n_covered++] = 8;
+    }
+  } else {
+    return;
+  }
+  for (unsigned int i = 0; i < n_covered; i++) {
+    vm->decoded[addr + covered[i]].covered = 1;
+  }
+}
+
+// Drops the superinstructions that depend on the cell at addr.
+static void intcode_vm_uncover(intcode_vm* vm, unsigned int addr) {
+  for (unsigned int back = 1; back < MAX_FUSED_LENGTH && back <= addr; back++) {
+    intcode_decoded* head = &vm->decoded[addr - back];
+    if (head->op >= DECODED_STORE && head->length > back) {
+      head->op = DECODED_NONE;
+    }
+  }
+  vm->decoded[addr].covered = 0;
+}
+
+static void intcode_vm_decode(intcode_vm* vm, unsigned int addr) {
+  intcode_decoded* d = &vm->decoded[addr];
+  intcode_int opcode = vm->mem[addr] % 100;
+  intcode_int modes = vm->mem[addr] / 100;
+
+  switch (opcode) {
+  case OP_ADD:  d->op = DECODED_ADD;  break;
+  case OP_MUL:  d->op = DECODED_MUL;  break;
+  case OP_IN:   d->op = DECODED_IN;   break;
+  case OP_OUT:  d->op = DECODED_OUT;  break;
+  case OP_JT:   d->op = DECODED_JT;   break;
+  case OP_JF:   d->op = DECODED_JF;   break;
+  case OP_LT:   d->op = DECODED_LT;   break;
+  case OP_EQ:   d->op = DECODED_EQ;   break;
+  case OP_ARB:  d->op = DECODED_ARB;  break;
+  case OP_HALT: d->op = DECODED_HALT; break;
+  case OP_DIV:  d->op = DECODED_DIV;  break;
+  case OP_JGE:  d->op = DECODED_JGE;  break;
+  default:      d->op = DECODED_INVALID; break;
+  }
+  d->length = 1 + intcode_vm_get_opcode_n_operands(opcode);
+  d->mode[0] = modes % 10;
+  d->mode[1] = modes / 10 % 10;
+  d->mode[2] = modes / 100 % 10;
+  // Operands are read without bounds checks, so they must all be in memory.
+  if (d->op != DECODED_INVALID && vm->mem_size - addr < d->length) {
+    d->op = DECODED_TRUNCATED;
+  }
+#ifndef INTCODE_NO_FUSION
+  intcode_vm_fuse(vm, addr);
+#endif
+#ifdef INTCODE_PROFILE
+  for (unsigned int i = 0; i < d->length && addr + i < vm->mem_size; i++) {
+    vm->profile->code[addr + i] = 1;
+  }
+#endif
+  // Writes past the last decoded cells do not need to touch the table, so
+  // data that is never executed costs nothing.
+  if (vm->decoded_end < addr + MAX_FUSED_LENGTH) {
+    vm->decoded_end = addr + MAX_FUSED_LENGTH;
+  }
+}
+
+static intcode_int intcode_vm_panic_at(intcode_vm* vm, unsigned int ip, const char* reason) {
+  vm->ip = ip;
+  return intcode_vm_panic(vm, reason);
+}
+
+static intcode_status intcode_vm_execute(intcode_vm*);
+
+intcode_status intcode_vm_run(intcode_vm* vm) {
+  // A panic jumps back here instead of exiting.
+  jmp_buf on_panic;
+  intcode_status status = INTCODE_PANICKED;
+  vm->error = NULL;
+  vm->on_panic = &on_panic;
+  if (setjmp(on_panic) == 0) {
+    status = intcode_vm_execute(vm);
+  }
+  vm->on_panic = NULL;
+  return status;
+}
+
+// Runs about `n` instructions at most: the VM pauses at the first jump
+// after them, since only a jump can keep it running for long.
+intcode_status intcode_vm_run_slice(intcode_vm* vm, unsigned long long n) {
+  vm->slice_end = vm->n_executed + n;
+  intcode_status status = intcode_vm_run(vm);
+  vm->slice_end = ULLONG_MAX;
+  return status;
+}
+
+// Same semantics as intcode_vm_run_uncached, but the opcode and modes of
+// every executed cell are decoded once into vm->decoded, and common
+// sequences run as a single superinstruction. Operands are still read from
+// memory each time, since compiled code patches them as it runs; a write to
+// a cell drops its decoded entry in case it was an opcode.
+static intcode_status intcode_vm_execute(intcode_vm* vm) {
+  if (vm->decoded == NULL) {
+    vm->decoded = (intcode_decoded*)calloc(vm->mem_size, sizeof(intcode_decoded));
+  }
+#ifdef INTCODE_PROFILE
+  if (vm->profile == NULL) {
+    vm->profile = (intcode_profile*)calloc(1, sizeof(intcode_profile));
+    vm->profile->executed = (unsigned long long*)calloc(vm->mem_size, sizeof(unsigned long long));
+    vm->profile->code_writes = (unsigned long long*)calloc(vm->mem_size, sizeof(unsigned long long));
+    vm->profile->code = (unsigned char*)calloc(vm->mem_size, 1);
+  }
+  intcode_profile* profile = vm->profile;
+#endif
+
+  intcode_int* mem = vm->mem;
+  intcode_decoded* decoded = vm->decoded;
+  unsigned int ip = vm->ip;
+  const intcode_decoded* d;
+
+#define PANIC(reason) intcode_vm_panic_at(vm, ip, reason)
+#define CHECK_POSITION(position) (vm->mem_size <= (unsigned int)(position) ? PANIC("bad position") : (position))
+#define POSITION_AT(addr, mode) CHECK_POSITION((mode) == MODE_RELATIVE ? vm->relative_base + mem[addr] : mem[addr])
+#define VALUE_AT(addr, mode) ((mode) == MODE_IMMEDIATE ? mem[addr] : mem[POSITION_AT(addr, mode)])
+#define OPERAND_POSITION(n) POSITION_AT(ip + n, d->mode[n - 1])
+#define OPERAND_VALUE(n) VALUE_AT(ip + n, d->mode[n - 1])
+#define WRITE(position, value) do { \
+    intcode_int at = (position); \
+    mem[at] = (value); \
+    if (at < vm->decoded_end) { \
+      if (decoded[at].covered) intcode_vm_uncover(vm, at); \
+      decoded[at].op = DECODED_NONE; \
+      PROFILE_WRITE(at); \
+    } \
+  } while (0)
+#define WRITE_OPERAND(n, value) WRITE(OPERAND_POSITION(n), value)
+
+#ifdef DEBUG
+#define TRACE() (vm->ip = ip, intcode_vm_decode_and_print(vm, ip))
+#else
+#define TRACE()
+#endif
+
+#ifdef INTCODE_PROFILE
+#define PROFILE_EXECUTE() do { \
+    intcode_int opcode = mem[ip] % 100; \
+    profile->executed[ip]++; \
+    if (opcode >= 0) profile->opcodes[opcode]++; \
+  } while (0)
+#define PROFILE_WRITE(at) do { \
+    if (profile->code[at]) { \
+      profile->code_writes[at]++; \
+      profile->n_code_writes++; \
+    } \
+  } while (0)
+#define PROFILE_UNDO() do { \
+    intcode_int opcode = mem[ip] % 100; \
+    profile->executed[ip]--; \
+    if (opcode >= 0) profile->opcodes[opcode]--; \
+  } while (0)
+#else
+#define PROFILE_EXECUTE()
+#define PROFILE_WRITE(at)
+#define PROFILE_UNDO()
+#endif
+
+  // Fetch the next instruction and decode it unless it already is.
+#define FETCH() do { \
+    if (ip >= vm->mem_size) goto out_of_memory; \
+    d = &decoded[ip]; \
+    if (d->op == DECODED_NONE) intcode_vm_decode(vm, ip); \
+    vm->n_executed++; \
+    vm->n_dispatched++; \
+    PROFILE_EXECUTE(); \
+    TRACE(); \
+  } while (0)
+
+  // Stops before the current instruction, which runs again when the VM
+  // is resumed, so it is not counted yet.
+#define YIELD(status) do { \
+    vm->n_executed--; \
+    vm->n_dispatched--; \
+    PROFILE_UNDO(); \
+    vm->ip = ip; \
+    return status; \
+  } while (0)
+
+  // Jumps, pausing first if the slice of intcode_vm_run_slice ran out.
+  // Not a do-while, so that NEXT() can continue the switch loop.
+#define JUMP(target) \
+    ip = (target); \
+    if (vm->n_executed >= vm->slice_end) { \
+      vm->ip = ip; \
+      return INTCODE_PAUSED; \
+    } \
+    NEXT()
+
+  // Moves on to the next instruction of a superinstruction, or leaves it if
+  // the last write dropped it.
+#define STEP(size) \
+    ip += size; \
+    if (d->op == DECODED_NONE) NEXT(); \
+    vm->n_executed++; \
+    PROFILE_EXECUTE(); \
+    TRACE()
+
+#ifdef INTCODE_COMPUTED_GOTO
+  static const void* handlers[N_DECODED] = {
+    [DECODED_NONE] = &&handle_DECODED_INVALID,
+    [DECODED_ADD] = &&handle_DECODED_ADD, [DECODED_MUL] = &&handle_DECODED_MUL,
+    [DECODED_IN] = &&handle_DECODED_IN, [DECODED_OUT] = &&handle_DECODED_OUT,
+    [DECODED_JT] = &&handle_DECODED_JT, [DECODED_JF] = &&handle_DECODED_JF,
+    [DECODED_LT] = &&handle_DECODED_LT, [DECODED_EQ] = &&handle_DECODED_EQ,
+    [DECODED_ARB] = &&handle_DECODED_ARB, [DECODED_HALT] = &&handle_DECODED_HALT,
+    [DECODED_DIV] = &&handle_DECODED_DIV, [DECODED_JGE] = &&handle_DECODED_JGE,
+    [DECODED_INVALID] = &&handle_DECODED_INVALID,
+    [DECODED_TRUNCATED] = &&handle_DECODED_TRUNCATED,
+    [DECODED_STORE] = &&handle_DECODED_STORE, [DECODED_PUSH] = &&handle_DECODED_PUSH,
+    [DECODED_CALL] = &&handle_DECODED_CALL, [DECODED_LOAD] = &&handle_DECODED_LOAD,
+    [DECODED_POP] = &&handle_DECODED_POP, [DECODED_RET] = &&handle_DECODED_RET,
+  };
+#define HANDLER(op) handle_##op:
+#define NEXT() do { FETCH(); goto *handlers[d->op]; } while (0)
+  NEXT();
+#else
+#define HANDLER(op) case op:
+#define NEXT() continue
+  for (;;) {
+    FETCH();
+    switch (d->op) {
+#endif
+
+  HANDLER(DECODED_ADD)
+    WRITE_OPERAND(3, OPERAND_VALUE(1) + OPERAND_VALUE(2));
+    ip += 4;
+    NEXT();
+  HANDLER(DECODED_MUL)
+    WRITE_OPERAND(3, OPERAND_VALUE(1) * OPERAND_VALUE(2));
+    ip += 4;
+    NEXT();
+  HANDLER(DECODED_IN) {
+    intcode_int value;
+    if (vm->input == NULL || !intcode_ring_pop(vm->input, &value)) {
+      YIELD(INTCODE_NEED_INPUT);
+    }
+    WRITE_OPERAND(1, value);
+    ip += 2;
+    NEXT();
+  }
+  HANDLER(DECODED_OUT)
+    if (vm->output == NULL || !intcode_ring_push(vm->output, OPERAND_VALUE(1))) {
+      YIELD(INTCODE_HAVE_OUTPUT);
+    }
+    ip += 2;
+    NEXT();
+  HANDLER(DECODED_JT)
+    JUMP(OPERAND_VALUE(1) != 0 ? OPERAND_VALUE(2) : ip + 3);
+  HANDLER(DECODED_JF)
+    JUMP(OPERAND_VALUE(1) == 0 ? OPERAND_VALUE(2) : ip + 3);
+  HANDLER(DECODED_LT)
+    WRITE_OPERAND(3, OPERAND_VALUE(1) < OPERAND_VALUE(2));
+    ip += 4;
+    NEXT();
+  HANDLER(DECODED_EQ)
+    WRITE_OPERAND(3, OPERAND_VALUE(1) == OPERAND_VALUE(2));
+    ip += 4;
+    NEXT();
+  HANDLER(DECODED_ARB)
+    vm->relative_base += OPERAND_VALUE(1);
+    ip += 2;
+    NEXT();
+  HANDLER(DECODED_HALT)
+    // ip stays on HALT, so running the VM again halts again.
+    vm->ip = ip;
+    return INTCODE_HALTED;
+  HANDLER(DECODED_DIV)
+    WRITE_OPERAND(3, OPERAND_VALUE(1) / OPERAND_VALUE(2));
+    ip += 4;
+    NEXT();
+  HANDLER(DECODED_JGE)
+    JUMP(OPERAND_VALUE(1) >= OPERAND_VALUE(2) ? OPERAND_VALUE(3) : ip + 4);
+  HANDLER(DECODED_TRUNCATED)
+    PANIC("bad position");
+    NEXT();
+  HANDLER(DECODED_INVALID)
+#ifndef INTCODE_COMPUTED_GOTO
+    default:
+#endif
+    PANIC("wrong opcode");
+    NEXT();
+
+  // Superinstructions, see intcode_vm_fuse. ip moves along with the
+  // instruction being executed, so panics point at the right one.
+  HANDLER(DECODED_STORE)
+  HANDLER(DECODED_PUSH)
+  HANDLER(DECODED_CALL)
+    // add A, B, $+4
+    WRITE(ip + 7, VALUE_AT(ip + 1, d->mode[0]) + VALUE_AT(ip + 2, d->mode[1]));
+    STEP(4);
+    // add 0, X, <patched>
+    WRITE(POSITION_AT(ip + 3, MODE_POSITION), mem[ip + 1] + VALUE_AT(ip + 2, d->mode[2]));
+    if (d->op == DECODED_STORE) {
+      ip += 4;
+      NEXT();
+    }
+    STEP(4);
+    // add S, -1, S
+    WRITE(POSITION_AT(ip + 3, MODE_POSITION), mem[POSITION_AT(ip + 1, MODE_POSITION)] + mem[ip + 2]);
+    if (d->op == DECODED_PUSH) {
+      ip += 4;
+      NEXT();
+    }
+    STEP(4);
+    // jge 0, 0, F
+    JUMP(mem[ip + 1] >= mem[ip + 2] ? mem[POSITION_AT(ip + 3, MODE_POSITION)] : ip + 4);
+
+  HANDLER(DECODED_LOAD)
+  HANDLER(DECODED_POP)
+  HANDLER(DECODED_RET)
+    // add A, B, $+3
+    WRITE(ip + 6, VALUE_AT(ip + 1, d->mode[0]) + VALUE_AT(ip + 2, d->mode[1]));
+    STEP(4);
+    // add 0, <patched>, Y
+    WRITE(POSITION_AT(ip + 3, d->mode[2]), mem[ip + 1] + mem[POSITION_AT(ip + 2, MODE_POSITION)]);
+    if (d->op == DECODED_LOAD) {
+      ip += 4;
+      NEXT();
+    }
+    STEP(4);
+    if (d->op == DECODED_POP) {
+      // add S, 1, S
+      WRITE(POSITION_AT(ip + 3, MODE_POSITION), mem[POSITION_AT(ip + 1, MODE_POSITION)] + mem[ip + 2]);
+      ip += 4;
+      NEXT();
+    }
+    // jge 0, 0, <patched>
+    JUMP(mem[ip + 1] >= mem[ip + 2] ? mem[ip + 3] : ip + 4);
+
+#ifndef INTCODE_COMPUTED_GOTO
+    }
+  }
+#endif
+
+out_of_memory:
+  vm->ip = ip;
+  return INTCODE_HALTED;
+#undef PANIC
+#undef CHECK_POSITION
+#undef POSITION_AT
+#undef VALUE_AT
+#undef OPERAND_POSITION
+#undef OPERAND_VALUE
+#undef WRITE
+#undef WRITE_OPERAND
+#undef TRACE
+#undef PROFILE_EXECUTE
+#undef PROFILE_WRITE
+#undef PROFILE_UNDO
+#undef YIELD
+#undef JUMP
+#undef FETCH
+#undef STEP
+#undef HANDLER
+#undef NEXT
+}
+
+// Writes the profile of the last runs as JSON, with only the addresses that
+// were executed or written to. Returns 0 on success.
+int intcode_vm_write_profile(intcode_vm* vm, const char* path) {
+  const intcode_profile* profile = vm->profile;
+  if (profile == NULL) {
+    return -1;
+  }
+  FILE* fp = fopen(path, "w");
+  if (fp == NULL) {
+    return -1;
+  }
+
+  fprintf(fp, "{\"executed\": %llu, \"dispatched\": %llu, \"opcodes\": {",
+          vm->n_executed, vm->n_dispatched);
+  const char* separator = "";
+  for (int opcode = 0; opcode < 100; opcode++) {
+    if (profile->opcodes[opcode]) {
+      fprintf(fp, "%s\"%s\": %llu", separator,
+              intcode_vm_get_opcode_str(opcode), profile->opcodes[opcode]);
+      separator = ", ";
+    }
+  }
+
+  // [address, count] pairs
+  fprintf(fp, "},\n\"addresses\": [");
+  separator = "";
+  for (unsigned int addr = 0; addr < vm->mem_size; addr++) {
+    if (profile->executed[addr]) {
+      fprintf(fp, "%s[%u, %llu]", separator, addr, profile->executed[addr]);
+      separator = ", ";
+    }
+  }
+
+  fprintf(fp, "],\n\"code_writes\": %llu, \"code_write_addresses\": [",
+          profile->n_code_writes);
+  separator = "";
+  for (unsigned int addr = 0; addr < vm->mem_size; addr++) {
+    if (profile->code_writes[addr]) {
+      fprintf(fp, "%s[%u, %llu]", separator, addr, profile->code_writes[addr]);
+      separator = ", ";
+    }
+  }
+  fprintf(fp, "]}\n");
+  return fclose(fp) == 0 ? 0 : -1;
 }
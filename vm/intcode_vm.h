@@ -1,31 +1,149 @@
 #ifndef __INTCODE_VM
 #define __INTCODE_VM
 
+#include <stddef.h>
+#include <setjmp.h>
+
 typedef signed long long   intcode_int;
 
+// Compiled Intlang code is dispatched with computed gotos where the C
+// compiler has them (GCC and Clang), and a switch otherwise.
+#if defined(__GNUC__) && !defined(INTCODE_NO_COMPUTED_GOTO)
+#define INTCODE_COMPUTED_GOTO
+#endif
+
+// What intcode_vm_run decoded from an opcode cell
+typedef struct {
+  unsigned char op;       // handler, 0 if the cell is not decoded (yet)
+  unsigned char length;   // number of cells, 1 + number of operands unless fused
+  unsigned char mode[3];  // mode of each operand
+  unsigned char covered;  // a superinstruction depends on this cell
+} intcode_decoded;
+
+// Counters kept by intcode_vm_run when built with -DINTCODE_PROFILE. Code
+// is every cell of an instruction executed so far, so writes into it are
+// the self-modifying ones, whatever the section layout.
+typedef struct {
+  unsigned long long  opcodes[100];   // instructions executed per opcode
+  unsigned long long* executed;       // instructions executed per address
+  unsigned long long* code_writes;    // writes into code per address
+  unsigned long long  n_code_writes;
+  unsigned char*      code;           // 1 for the cells of executed instructions
+} intcode_profile;
+
+// A queue of values in caller-owned cells, for the input and the output of
+// a VM. Values are at cells[(start + i) % capacity] for i < size.
+typedef struct {
+  intcode_int* cells;
+  size_t       capacity;
+  size_t       start;
+  size_t       size;
+} intcode_ring;
+
+static inline void intcode_ring_init(intcode_ring* ring, intcode_int* cells, size_t capacity) {
+  ring->cells = cells;
+  ring->capacity = capacity;
+  ring->start = 0;
+  ring->size = 0;
+}
+
+// Returns 0 if the ring is full.
+static inline int intcode_ring_push(intcode_ring* ring, intcode_int value) {
+  if (ring->size == ring->capacity) return 0;
+  ring->cells[(ring->start + ring->size++) % ring->capacity] = value;
+  return 1;
+}
+
+// Returns 0 if the ring is empty.
+static inline int intcode_ring_pop(intcode_ring* ring, intcode_int* value) {
+  if (ring->size == 0) return 0;
+  *value = ring->cells[ring->start];
+  ring->start = (ring->start + 1) % ring->capacity;
+  ring->size--;
+  return 1;
+}
+
+// Why intcode_vm_run returned. The VM can be run again after NEED_INPUT and
+// HAVE_OUTPUT, and continues with the instruction it stopped at.
+typedef enum {
+  INTCODE_HALTED,       // HALT, or ip ran off the end of memory
+  INTCODE_NEED_INPUT,   // IN with an empty input ring
+  INTCODE_HAVE_OUTPUT,  // OUT with a full output ring
+  INTCODE_PANICKED,     // see vm->error; vm->ip is the faulty instruction
+  INTCODE_PAUSED,       // the instructions given to intcode_vm_run_slice ran out
+} intcode_status;
+
 typedef struct {
   unsigned int ip;
   unsigned int mem_size;
   intcode_int* mem;
+  void*        mapping;       // set when mem points into a mapped image
+  size_t       mapping_size;
+  unsigned long long n_executed;  // instructions executed so far
+  unsigned long long n_dispatched;  // of which dispatched one at a time or as the
+                                    // first instruction of a superinstruction
+  unsigned long long slice_end;  // jumps pause the VM once n_executed reaches it
+  intcode_int  relative_base;
+  intcode_decoded* decoded;   // one entry per cell, allocated by intcode_vm_run;
+                              // clear an entry when writing to mem between runs
+  unsigned int decoded_end;   // no cell from here on is decoded
+  intcode_profile* profile;   // NULL unless built with -DINTCODE_PROFILE
+
+  intcode_ring* input;        // read by IN, NULL for none
+  intcode_ring* output;       // written by OUT, NULL for none
+  const char*  error;         // why the last run panicked, or NULL
+  jmp_buf*     on_panic;
 } intcode_vm;
 
 intcode_vm* intcode_vm_new(const char*);
+intcode_vm* intcode_vm_new_from_text(const char*, size_t);
+intcode_vm* intcode_vm_new_from_image(const void*, size_t);
+intcode_vm* intcode_vm_new_from_cells(const intcode_int*, size_t);
+intcode_vm* intcode_vm_load(const char*);
 void        intcode_vm_destroy(intcode_vm**);
 
-intcode_int intcode_vm_run(intcode_vm*);
+intcode_status intcode_vm_run(intcode_vm*);
+intcode_status intcode_vm_run_slice(intcode_vm*, unsigned long long);
+void        intcode_vm_attach(intcode_vm*, intcode_ring*, intcode_ring*);
+const char* intcode_vm_get_error(intcode_vm*);
+unsigned long long intcode_vm_get_n_executed(intcode_vm*);
+intcode_int intcode_vm_run_uncached(intcode_vm*);
+int         intcode_vm_write_profile(intcode_vm*, const char*);
 
 const char *intcode_vm_get_opcode_str(intcode_int);
 unsigned int intcode_vm_get_opcode_n_operands(intcode_int);
 unsigned int intcode_vm_decode_and_print(intcode_vm*, intcode_int);
 intcode_int intcode_vm_panic(intcode_vm*, const char*);
 
+// Binary image (python -m intlang --format=bin): a header followed by
+// n_cells little-endian int64 cells.
+#define INTCODE_IMAGE_MAGIC "INTCODE"
+
+typedef struct {
+  char        magic[8];
+  intcode_int n_cells;
+  intcode_int sections[4];  // start of stack, text, data, heap
+} intcode_image_header;
+
+int intcode_is_image(const void*, size_t);
+
 // Opcodes
 #define OP_ADD  1
 #define OP_MUL  2
 #define OP_IN   3
 #define OP_OUT  4
+#define OP_JT   5
+#define OP_JF   6
+#define OP_LT   7
+#define OP_EQ   8
+#define OP_ARB  9
 #define OP_HALT 99
 
+// Parameter modes
+#define MODE_POSITION  0
+#define MODE_IMMEDIATE 1
+#define MODE_RELATIVE  2
+
 // Opcodes (added)
 #define OP_DIV  50
 #define OP_JGE  60
@@ -1,8 +1,81 @@
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
 #include "intcode_vm.h"
 
-#define MAX_FILE_SIZE 1024 * 1024 * 10  // 10MB
+#define RING_SIZE 4096
+
+// Unparsed bytes read from stdin
+static char stdin_buf[65536];
+static size_t stdin_len = 0;
+static int stdin_eof = 0;
+
+static int is_space(char c) {
+  return c == ' ' || c == '\t' || c == '\r' || c == '\n';
+}
+
+// Parses the integers read so far into the ring, keeping a number that may
+// continue in the next read. Returns 0 on malformed input.
+static int parse_input(intcode_ring* input) {
+  size_t i = 0;
+  while (input->size < input->capacity) {
+    while (i < stdin_len && is_space(stdin_buf[i])) i++;
+    if (i == stdin_len) break;
+    // stdin_buf is not NUL-terminated, so the digits are converted here
+    // rather than with strtoll.
+    size_t start = i;
+    int negative = i < stdin_len && stdin_buf[i] == '-';
+    if (negative) i++;
+    size_t digits = i;
+    unsigned long long value = 0;
+    while (i < stdin_len && stdin_buf[i] >= '0' && stdin_buf[i] <= '9') {
+      value = value * 10 + (unsigned long long)(stdin_buf[i] - '0');
+      i++;
+    }
+    if (i == stdin_len && !stdin_eof) {
+      i = start;
+      break;
+    }
+    if (i == digits || (i < stdin_len && !is_space(stdin_buf[i]))) return 0;
+    intcode_ring_push(input, negative ? -(intcode_int)value : (intcode_int)value);
+  }
+  memmove(stdin_buf, stdin_buf + i, stdin_len - i);
+  stdin_len -= i;
+  return 1;
+}
+
+// Reads stdin until at least one value is in the ring. A single read takes
+// whatever is available, so piped input is taken in bulk while interactive
+// input still goes a line at a time. Returns 0 at the end of the input.
+static int read_input(intcode_ring* input) {
+  while (input->size == 0) {
+    if (!parse_input(input)) {
+      fprintf(stderr, "Malformed input\n");
+      exit(1);
+    }
+    if (input->size > 0) break;
+    if (stdin_eof) return 0;
+    if (stdin_len == sizeof(stdin_buf)) {
+      fprintf(stderr, "Malformed input\n");
+      exit(1);
+    }
+    ssize_t n = read(0, stdin_buf + stdin_len, sizeof(stdin_buf) - stdin_len);
+    if (n <= 0) {
+      stdin_eof = 1;
+    } else {
+      stdin_len += n;
+    }
+  }
+  return 1;
+}
+
+static void write_output(intcode_ring* output) {
+  intcode_int value;
+  while (intcode_ring_pop(output, &value)) {
+    printf("%lld\n", value);
+  }
+}
 
 
 void print_usage(char *argv0) {
@@ -17,12 +90,12 @@ int main(int argc, char **argv) {
     return 1;
   }
 
-  FILE* fp = fopen(argv[1], "r");
-  char *buf = (char *)malloc(MAX_FILE_SIZE);
-  fread(buf, 1, MAX_FILE_SIZE, fp);
-  fclose(fp);
-
-  intcode_vm* vm = intcode_vm_new(buf);
+  // Text programs and binary images are both detected by the loader.
+  intcode_vm* vm = intcode_vm_load(argv[1]);
+  if (vm == NULL) {
+    fprintf(stderr, "%s: cannot load program\n", argv[1]);
+    return 1;
+  }
 
   #ifdef DEBUG
   printf("================ MEMORY =================\n");
@@ -32,9 +105,41 @@ int main(int argc, char **argv) {
   printf("=========================================\n");
   #endif
 
-  intcode_vm_run(vm);
+  intcode_int input_cells[RING_SIZE], output_cells[RING_SIZE];
+  intcode_ring input, output;
+  intcode_ring_init(&input, input_cells, RING_SIZE);
+  intcode_ring_init(&output, output_cells, RING_SIZE);
+  intcode_vm_attach(vm, &input, &output);
+
+  intcode_status status;
+  while ((status = intcode_vm_run(vm)) != INTCODE_HALTED) {
+    write_output(&output);
+    if (status == INTCODE_PANICKED) {
+      intcode_vm_decode_and_print(vm, vm->ip);
+      printf("Panic: %s\n", intcode_vm_get_error(vm));
+      return 1;
+    }
+    if (status == INTCODE_NEED_INPUT) {
+      // Show what the program printed before it waits for input.
+      fflush(stdout);
+      if (!read_input(&input)) {
+        fprintf(stderr, "Unexpected end of input\n");
+        return 1;
+      }
+    }
+  }
+  write_output(&output);
+
+  if (getenv("INTCODE_STATS")) {
+    fprintf(stderr, "executed %llu instructions (%llu dispatches)\n", vm->n_executed, vm->n_dispatched);
+  }
+  #ifdef INTCODE_PROFILE
+  const char* profile_path = getenv("INTCODE_PROFILE");
+  if (profile_path && intcode_vm_write_profile(vm, profile_path) != 0) {
+    fprintf(stderr, "%s: cannot write profile\n", profile_path);
+  }
+  #endif
   intcode_vm_destroy(&vm);
-  free(buf);
 
   return 0;
 }
@@ -0,0 +1,42 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include "intcode_network.h"
+
+void print_usage(char *argv0) {
+  printf("[+] Intcode network (Advent of Code 2019)\n");
+  printf("Usage: %s [spec]\n", argv0);
+}
+
+int main(int argc, char **argv) {
+
+  if (argc <= 1) {
+    print_usage(argv[0]);
+    return 1;
+  }
+
+  intcode_network* net = intcode_network_load(argv[1]);
+  if (net == NULL) return 1;
+
+  if (intcode_network_run(net) != 0) {
+    fflush(stdout);
+    if (net->failed >= 0) {
+      intcode_node* node = &net->nodes[net->failed];
+      intcode_vm_decode_and_print(node->vm, node->vm->ip);
+      printf("Panic in %s: %s\n", node->name, net->error);
+    } else {
+      fprintf(stderr, "%s: %s\n", argv[1], net->error);
+    }
+    intcode_network_destroy(&net);
+    return 1;
+  }
+
+  if (getenv("INTCODE_STATS")) {
+    unsigned long long executed = 0;
+    for (unsigned int i = 0; i < net->n_nodes; i++) executed += net->nodes[i].vm->n_executed;
+    fprintf(stderr, "executed %llu instructions in %u nodes (%llu rounds)\n",
+            executed, net->n_nodes, net->n_rounds);
+  }
+  intcode_network_destroy(&net);
+
+  return 0;
+}
@@ -1,5 +1,9 @@
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
 #include "narwhal.h"
 #include "intcode_vm.h"
+#include "intcode_network.h"
 
 TEST(new_and_destroy) {
   intcode_vm* vm = intcode_vm_new("0,2,100");
@@ -15,19 +19,23 @@ TEST(new_and_destroy) {
 
 TEST(program_with_no_halt) {
   intcode_vm* vm = intcode_vm_new("1,0,1,0");
-  ASSERT_EQ(intcode_vm_run(vm), 1);
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_HALTED);
+  ASSERT_EQ(vm->mem[0], 1);
   intcode_vm_destroy(&vm);
 }
 
 TEST(program_with_newline) {
   intcode_vm* vm = intcode_vm_new("1,0,\n1,0");
-  ASSERT_EQ(intcode_vm_run(vm), 1);
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_HALTED);
+  ASSERT_EQ(vm->mem[0], 1);
   intcode_vm_destroy(&vm);
 }
 
 TEST(immediate_mode) {
   intcode_vm* vm = intcode_vm_new("1101,30,40,3,1002,3,50,0,99");
-  ASSERT_EQ(intcode_vm_run(vm), 3500);
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_HALTED);
+  ASSERT_EQ(vm->mem[0], 3500);
+  ASSERT_EQ(vm->n_executed, 3);
   intcode_vm_destroy(&vm);
 }
 
@@ -35,11 +43,13 @@ TEST(aoc_day2_example) {
   intcode_vm* vm;
 
   vm = intcode_vm_new("1,9,10,3,2,3,11,0,99,30,40,50");
-  ASSERT_EQ(intcode_vm_run(vm), 3500);
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_HALTED);
+  ASSERT_EQ(vm->mem[0], 3500);
   intcode_vm_destroy(&vm);
 
   vm = intcode_vm_new("1,0,0,0,99");
-  ASSERT_EQ(intcode_vm_run(vm), 2);
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_HALTED);
+  ASSERT_EQ(vm->mem[0], 2);
   intcode_vm_destroy(&vm);
 
   vm = intcode_vm_new("2,3,0,3,99");
@@ -53,16 +63,71 @@ TEST(aoc_day2_example) {
   intcode_vm_destroy(&vm);
 
   vm = intcode_vm_new("1,1,1,4,99,5,6,0,99");
-  ASSERT_EQ(intcode_vm_run(vm), 30);
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_HALTED);
+  ASSERT_EQ(vm->mem[0], 30);
   ASSERT_EQ(vm->mem[4], 2);
   intcode_vm_destroy(&vm);
 }
 
+TEST(aoc_day5_jumps_and_comparisons) {
+  intcode_vm* vm;
+
+  vm = intcode_vm_new("1108,8,8,0,99");
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_HALTED);
+  ASSERT_EQ(vm->mem[0], 1);
+  intcode_vm_destroy(&vm);
+
+  vm = intcode_vm_new("1107,8,3,0,99");
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_HALTED);
+  ASSERT_EQ(vm->mem[0], 0);
+  intcode_vm_destroy(&vm);
+
+  // Jump over the HALT at 3 to an ADD that stores 5 in 0
+  vm = intcode_vm_new("1105,1,4,99,1101,2,3,0,99");
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_HALTED);
+  ASSERT_EQ(vm->mem[0], 5);
+  intcode_vm_destroy(&vm);
+
+  vm = intcode_vm_new("1106,0,4,99,1101,2,3,0,99");
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_HALTED);
+  ASSERT_EQ(vm->mem[0], 5);
+  intcode_vm_destroy(&vm);
+
+  vm = intcode_vm_new("1106,1,4,99,1101,2,3,0,99");
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_HALTED);
+  ASSERT_EQ(vm->mem[0], 1106);
+  intcode_vm_destroy(&vm);
+}
+
+TEST(aoc_day9_relative_mode) {
+  intcode_vm* vm;
+
+  // rb = 10, then mem[rb - 5] = 2 + 3
+  vm = intcode_vm_new("109,10,21101,2,3,-5,99");
+  intcode_vm_run(vm);
+  ASSERT_EQ(vm->relative_base, 10);
+  ASSERT_EQ(vm->mem[5], 5);
+  intcode_vm_destroy(&vm);
+
+  // rb = 7, then mem[0] = mem[rb + 0] + mem[rb + 1]
+  vm = intcode_vm_new("109,7,22201,0,1,-7,99,30,40");
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_HALTED);
+  ASSERT_EQ(vm->mem[0], 70);
+  intcode_vm_destroy(&vm);
+
+  // ARB reads its operand through the current relative base too: rb = 4 + -1
+  vm = intcode_vm_new("109,4,209,-1,99");
+  intcode_vm_run(vm);
+  ASSERT_EQ(vm->relative_base, 3);
+  intcode_vm_destroy(&vm);
+}
+
 // Added, not in the original spec.
 
 TEST(added_div) {
   intcode_vm* vm = intcode_vm_new("1150,10,5,0");
-  ASSERT_EQ(intcode_vm_run(vm), 2);
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_HALTED);
+  ASSERT_EQ(vm->mem[0], 2);
   intcode_vm_destroy(&vm);
 }
 
@@ -72,3 +137,321 @@ TEST(added_jge) {
   ASSERT_EQ(vm->mem[9], 101);
   intcode_vm_destroy(&vm);
 }
+
+TEST(decoded_cache_invalidation) {
+  // The instruction at 4 runs as an ADD, then the program patches it into a
+  // MUL and jumps back, so a stale decoded entry would write 11 again.
+  const char* source =
+    "1001,20,1,20,"   // counter += 1
+    "1101,5,6,21,"    // mem[21] = 5 + 6, patched into 5 * 6
+    "1101,0,1102,4,"  // mem[4] = 1102
+    "1007,20,2,22,"   // mem[22] = counter < 2
+    "1005,22,0,"      // if mem[22] goto 0
+    "99,0,0,0";
+  intcode_vm* cached = intcode_vm_new(source);
+  intcode_vm* uncached = intcode_vm_new(source);
+
+  intcode_vm_run(cached);
+  intcode_vm_run_uncached(uncached);
+  ASSERT_EQ(cached->mem[21], 30);
+  ASSERT_EQ(cached->n_executed, uncached->n_executed);
+  ASSERT_EQ(cached->ip, uncached->ip);
+  ASSERT_EQ(memcmp(cached->mem, uncached->mem, cached->mem_size * sizeof(intcode_int)), 0);
+
+  intcode_vm_destroy(&cached);
+  intcode_vm_destroy(&uncached);
+}
+
+TEST(superinstructions) {
+  // A push (see FunctionBuilder.push) of 42 with the stack pointer at 13
+  const char* push = "101,0,13,7,1101,0,42,0,1001,13,-1,13,99,16,0,0,0";
+  intcode_vm* vm = intcode_vm_new(push);
+  intcode_vm_run(vm);
+  ASSERT_EQ(vm->mem[16], 42);
+  ASSERT_EQ(vm->mem[13], 15);
+  ASSERT_EQ(vm->n_executed, 4);
+#ifndef INTCODE_NO_FUSION
+  ASSERT_EQ(vm->n_dispatched, 2);
+#endif
+  intcode_vm_destroy(&vm);
+
+  // The same push with the stack pointer on the opcode of its last ADD: it
+  // becomes `add 13, -1, 13` halfway, and the rest must run as written.
+  const char* patched = "101,0,13,7,1101,0,1101,0,1001,13,-1,13,99,8";
+  intcode_vm* cached = intcode_vm_new(patched);
+  intcode_vm* uncached = intcode_vm_new(patched);
+  intcode_vm_run(cached);
+  intcode_vm_run_uncached(uncached);
+  ASSERT_EQ(cached->mem[13], 12);
+  ASSERT_EQ(cached->n_executed, uncached->n_executed);
+  ASSERT_EQ(memcmp(cached->mem, uncached->mem, cached->mem_size * sizeof(intcode_int)), 0);
+  intcode_vm_destroy(&cached);
+  intcode_vm_destroy(&uncached);
+}
+
+TEST(resumable_io) {
+  // Prints the sum of each pair of inputs until it reads a 0.
+  intcode_vm* vm = intcode_vm_new("3,14,3,15,1,14,15,16,4,16,1005,14,0,99,0,0,0");
+  intcode_int input_cells[2], output_cells[2];
+  intcode_ring input, output;
+  intcode_ring_init(&input, input_cells, 2);
+  intcode_ring_init(&output, output_cells, 2);
+  intcode_vm_attach(vm, &input, &output);
+
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_NEED_INPUT);
+  ASSERT_EQ(vm->ip, 0);
+  ASSERT_EQ(vm->n_executed, 0);
+  intcode_ring_push(&input, 1);
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_NEED_INPUT);
+  ASSERT_EQ(vm->ip, 2);
+  intcode_ring_push(&input, 2);
+  intcode_ring_push(&input, 30);
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_NEED_INPUT);
+  ASSERT_EQ(vm->ip, 2);
+  intcode_ring_push(&input, 40);
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_NEED_INPUT);
+  ASSERT_EQ(output.size, 2);
+
+  // The third sum does not fit until the output is read.
+  intcode_ring_push(&input, 0);
+  intcode_ring_push(&input, 5);
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_HAVE_OUTPUT);
+  ASSERT_EQ(vm->ip, 8);
+  intcode_int value;
+  ASSERT(intcode_ring_pop(&output, &value));
+  ASSERT_EQ(value, 3);
+  ASSERT(intcode_ring_pop(&output, &value));
+  ASSERT_EQ(value, 70);
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_HALTED);
+  ASSERT(intcode_ring_pop(&output, &value));
+  ASSERT_EQ(value, 5);
+  ASSERT_EQ(vm->ip, 13);
+  ASSERT_EQ(vm->n_executed, 3 * 5 + 1);
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_HALTED);
+  intcode_vm_destroy(&vm);
+
+  // A panic returns instead of exiting.
+  vm = intcode_vm_new("1,0,0,100,99");
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_PANICKED);
+  ASSERT_EQ(strcmp(intcode_vm_get_error(vm), "bad position"), 0);
+  ASSERT_EQ(vm->ip, 0);
+  intcode_vm_destroy(&vm);
+}
+
+TEST(run_slice) {
+  // Counts in mem[5] forever
+  intcode_vm* vm = intcode_vm_new("101,1,5,5,1105,0,0");
+  vm->mem[5] = 0;
+  ASSERT_EQ(intcode_vm_run_slice(vm, 10), INTCODE_PAUSED);
+  ASSERT_EQ(vm->n_executed, 10);
+  ASSERT_EQ(vm->ip, 0);
+  ASSERT_EQ(vm->mem[5], 5);
+  // A slice ends at the first jump after it ran out.
+  ASSERT_EQ(intcode_vm_run_slice(vm, 3), INTCODE_PAUSED);
+  ASSERT_EQ(vm->n_executed, 14);
+  intcode_vm_destroy(&vm);
+
+  vm = intcode_vm_new("1101,30,40,3,1002,3,50,0,99");
+  ASSERT_EQ(intcode_vm_run_slice(vm, 100), INTCODE_HALTED);
+  ASSERT_EQ(vm->mem[0], 3500);
+  intcode_vm_destroy(&vm);
+}
+
+#ifdef INTCODE_PROFILE
+TEST(profile) {
+  // The program of decoded_cache_invalidation: two rounds of a loop that
+  // patches the instruction at 4.
+  intcode_vm* vm = intcode_vm_new(
+    "1001,20,1,20,1101,5,6,21,1101,0,1102,4,1007,20,2,22,1005,22,0,99,0,0,0");
+  intcode_vm_run(vm);
+
+  ASSERT_EQ(vm->profile->executed[0], 2);
+  ASSERT_EQ(vm->profile->executed[4], 2);
+  ASSERT_EQ(vm->profile->executed[19], 1);
+  ASSERT_EQ(vm->profile->executed[20], 0);
+  ASSERT_EQ(vm->profile->opcodes[OP_ADD], 5);
+  ASSERT_EQ(vm->profile->opcodes[OP_MUL], 1);
+  ASSERT_EQ(vm->profile->opcodes[OP_JT], 2);
+  ASSERT_EQ(vm->profile->opcodes[OP_HALT], 1);
+  // Only the patch writes into code; 20-22 are data.
+  ASSERT_EQ(vm->profile->n_code_writes, 2);
+  ASSERT_EQ(vm->profile->code_writes[4], 2);
+
+  char path[] = "/tmp/intcode_profile_XXXXXX";
+  int fd = mkstemp(path);
+  close(fd);
+  ASSERT_EQ(intcode_vm_write_profile(vm, path), 0);
+  char report[1024] = {0};
+  FILE* fp = fopen(path, "r");
+  ASSERT(fread(report, 1, sizeof(report) - 1, fp) > 0);
+  fclose(fp);
+  unlink(path);
+  ASSERT(strstr(report, "\"opcodes\": {\"ADD\": 5, \"MUL\": 1,") != NULL);
+  ASSERT(strstr(report, "\"code_write_addresses\": [[4, 2]]") != NULL);
+
+  intcode_vm_destroy(&vm);
+}
+#endif
+
+TEST(malformed_text) {
+  ASSERT(intcode_vm_new("104,5,99,x,7") == NULL);
+  ASSERT(intcode_vm_new("104,5,99 7") == NULL);
+  ASSERT(intcode_vm_new("104,5,,99") == NULL);
+  ASSERT(intcode_vm_new("104,-") == NULL);
+  ASSERT(intcode_vm_new("1,0,0,0,99\n#") == NULL);
+
+  // A trailing comma and whitespace are fine.
+  intcode_vm* vm = intcode_vm_new(" 1, 0,\n0,0,\n99,\n");
+  ASSERT_EQ(vm->mem_size, 5);
+  intcode_vm_destroy(&vm);
+}
+
+TEST(binary_image) {
+  unsigned char image[sizeof(intcode_image_header) + 4 * sizeof(intcode_int)] = {0};
+  memcpy(image, INTCODE_IMAGE_MAGIC, sizeof(INTCODE_IMAGE_MAGIC));
+  image[8] = 4;                              // n_cells
+  unsigned char *cells = image + sizeof(intcode_image_header);
+  cells[0 * 8] = 0x4d; cells[0 * 8 + 1] = 0x04;  // 1101
+  cells[1 * 8] = 0xff; memset(cells + 1 * 8 + 1, 0xff, 7);  // -1
+  cells[2 * 8] = 0x2b; cells[2 * 8 + 1] = 0x01;  // 299
+  cells[3 * 8] = 0;
+
+  ASSERT(intcode_is_image(image, sizeof(image)));
+  ASSERT(!intcode_is_image("1,0,1,0", 8));
+  ASSERT_EQ(intcode_vm_new_from_image(image, sizeof(image) - 1), NULL);
+
+  intcode_vm* vm = intcode_vm_new_from_image(image, sizeof(image));
+  ASSERT_EQ(vm->mem_size, 4);
+  ASSERT_EQ(vm->mem[1], -1);
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_HALTED);
+  ASSERT_EQ(vm->mem[0], 298);
+  intcode_vm_destroy(&vm);
+}
+
+TEST(load_file) {
+  char path[] = "/tmp/intcode_test_XXXXXX";
+  int fd = mkstemp(path);
+  ASSERT(fd >= 0);
+  const char *source = "1101, 30,40,3,\n1002,3,50,0,99\n";
+  ASSERT_EQ(write(fd, source, strlen(source)), (ssize_t)strlen(source));
+  close(fd);
+
+  intcode_vm* vm = intcode_vm_load(path);
+  ASSERT_EQ(vm->mem_size, 9);
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_HALTED);
+  ASSERT_EQ(vm->mem[0], 3500);
+  intcode_vm_destroy(&vm);
+  unlink(path);
+
+  char image_path[] = "/tmp/intcode_test_XXXXXX";
+  fd = mkstemp(image_path);
+  intcode_image_header header = { INTCODE_IMAGE_MAGIC, 4, { 0, 0, 4, 4 } };
+  intcode_int cells[4] = { 1101, -1, 299, 0 };
+  ASSERT_EQ(write(fd, &header, sizeof(header)), (ssize_t)sizeof(header));
+  ASSERT_EQ(write(fd, cells, sizeof(cells)), (ssize_t)sizeof(cells));
+  close(fd);
+
+  vm = intcode_vm_load(image_path);
+  ASSERT_EQ(vm->mem_size, 4);
+  ASSERT_EQ(intcode_vm_run(vm), INTCODE_HALTED);
+  ASSERT_EQ(vm->mem[0], 298);
+  intcode_vm_destroy(&vm);
+
+  // The image is mapped copy-on-write, so running it left the file intact.
+  vm = intcode_vm_load(image_path);
+  ASSERT_EQ(vm->mem[0], 1101);
+  intcode_vm_destroy(&vm);
+  unlink(image_path);
+
+  ASSERT_EQ(intcode_vm_load("/nonexistent/program.ic"), NULL);
+}
+
+// Reads `rounds` values, adding `step` to each and outputting it, then halts.
+static intcode_vm* relay(intcode_int step, intcode_int rounds) {
+  char source[64];
+  snprintf(source, sizeof(source), "3,16,1001,16,%lld,16,4,16,1001,17,-1,17,1005,17,0,99,0,%lld",
+           step, rounds);
+  return intcode_vm_new(source);
+}
+
+TEST(network_feedback_loop) {
+  // Advent of Code 2019 day 7, part 2: five amplifiers in a loop, each given
+  // its phase setting first, then the signal.
+  char program_path[] = "/tmp/intcode_test_XXXXXX";
+  int fd = mkstemp(program_path);
+  const char *program = "3,26,1001,26,-4,26,3,27,1002,27,2,27,1,27,26,"
+                        "27,4,27,1001,28,-1,28,1005,28,6,99,0,0,5";
+  ASSERT_EQ(write(fd, program, strlen(program)), (ssize_t)strlen(program));
+  close(fd);
+
+  char spec_path[] = "/tmp/intcode_test_XXXXXX";
+  fd = mkstemp(spec_path);
+  char spec[512];
+  snprintf(spec, sizeof(spec),
+           "# amplifiers\n"
+           "node a %s\nnode b %s\nnode c %s\nnode d %s\nnode e %s\n"
+           "a -> b -> c -> d -> e\n"
+           "e -> a  # feedback\n"
+           "input a 9 0\ninput b 8\ninput c 7\ninput d 6\ninput e 5\n",
+           program_path, program_path, program_path, program_path, program_path);
+  ASSERT_EQ(write(fd, spec, strlen(spec)), (ssize_t)strlen(spec));
+  close(fd);
+
+  intcode_network* net = intcode_network_load(spec_path);
+  ASSERT(net != NULL);
+  ASSERT_EQ(net->n_nodes, 5);
+  ASSERT_EQ(intcode_network_run(net), 0);
+  ASSERT(net->error == NULL);
+  // Each amplifier writes straight into the input of the next one.
+  ASSERT(net->nodes[4].vm->output == &net->nodes[0].input);
+  // The last signal e output
+  ASSERT_EQ(net->nodes[4].vm->mem[27], 139629729);
+  intcode_network_destroy(&net);
+  ASSERT(net == NULL);
+  unlink(spec_path);
+  unlink(program_path);
+}
+
+TEST(network_fan_out_and_in) {
+  intcode_network* net = intcode_network_new();
+  int source = intcode_network_add(net, "source", relay(0, 3));
+  int tens = intcode_network_add(net, "tens", relay(10, 3));
+  int hundreds = intcode_network_add(net, "hundreds", relay(100, 3));
+  // Adds up 6 inputs
+  int sum = intcode_network_add(net, "sum", intcode_vm_new("3,17,1,17,18,18,1001,19,-1,19,1005,19,0,99,0,0,0,0,0,6"));
+  intcode_network_connect(net, source, tens);
+  intcode_network_connect(net, source, hundreds);
+  intcode_network_connect(net, tens, sum);
+  intcode_network_connect(net, hundreds, sum);
+  ASSERT_EQ(intcode_network_find(net, "hundreds"), hundreds);
+  ASSERT_EQ(intcode_network_find(net, "missing"), -1);
+  intcode_network_feed(net, source, 1);
+  intcode_network_feed(net, source, 2);
+  intcode_network_feed(net, source, 3);
+
+  ASSERT_EQ(intcode_network_run(net), 0);
+  ASSERT_EQ(net->nodes[sum].vm->mem[18], 2 * (1 + 2 + 3) + 3 * 10 + 3 * 100);
+  intcode_network_destroy(&net);
+}
+
+TEST(network_deadlock) {
+  intcode_network* net = intcode_network_new();
+  int a = intcode_network_add(net, "a", relay(1, 10));
+  int b = intcode_network_add(net, "b", relay(1, 10));
+  intcode_network_connect(net, a, b);
+  intcode_network_connect(net, b, a);
+  ASSERT_EQ(intcode_network_run(net), -1);
+  ASSERT(net->error != NULL);
+  ASSERT_EQ(net->failed, -1);
+
+  // Once started, the values go around until both halted.
+  intcode_network_feed(net, a, 0);
+  ASSERT_EQ(intcode_network_run(net), 0);
+  ASSERT_EQ(net->nodes[b].vm->mem[16], 20);
+
+  // A panic names the node.
+  int c = intcode_network_add(net, "c", intcode_vm_new("1,0,0,100,99"));
+  ASSERT_EQ(intcode_network_run(net), -1);
+  ASSERT_EQ(net->failed, c);
+  intcode_network_destroy(&net);
+}